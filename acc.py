@@ -0,0 +1,69 @@
+import numpy as np
+
+from filters import FilterChain, design_sos, ACC_FS
+from parser import MSEC_PER_SEC
+
+# the band of human movement, gravity and the sensor noise are left out
+ACTIVITY_LOW_CUTOFF = 0.25
+ACTIVITY_HIGH_CUTOFF = 2.5
+ACTIVITY_FILTER_ORDER = 2
+# activity counts are summed per epoch
+EPOCH_SEC = 60
+
+def acc_columns(data):
+    """
+    data:   The acc samples of parser.decode_acc(), e.g. from
+            parser.parse_signals()
+    return: (timestamps, xyz), xyz is the (n, 3) int16 samples, or int32
+            when a sample doesn't fit
+    """
+    return data['ts'], data['xyz']
+
+def magnitude(xyz):
+    """ The euclidean norm of every x, y, z sample, float32 """
+    # int16 squares overflow
+    v = np.asarray(xyz, dtype=np.float32)
+    return np.sqrt(np.einsum('ij,ij->i', v, v))
+
+def magnitude_rows(ts, xyz):
+    """ Return [timestamp, magnitude] rows, like the other signals are plotted """
+    return np.column_stack((ts, magnitude(xyz)))
+
+def activity_sos(fs):
+    return np.vstack((design_sos("highpass", ACTIVITY_FILTER_ORDER, ACTIVITY_LOW_CUTOFF, fs),
+                      design_sos("lowpass", ACTIVITY_FILTER_ORDER, ACTIVITY_HIGH_CUTOFF, fs)))
+
+def activity_filter_chain(fs=ACC_FS):
+    """ A FilterChain of the movement band of the magnitude """
+    return FilterChain([activity_sos(fs)])
+
+def activity_counts(ts, xyz, fs=ACC_FS, epoch_sec=EPOCH_SEC):
+    """
+    ts:        The timestamps (ms) of the samples
+    xyz:       The (n, 3) samples
+    fs:        The sampling rate (Hz)
+    epoch_sec: The length of an epoch
+    return:    [epoch start (ms), counts] rows of every epoch with samples
+
+    The counts of an epoch are the integral of the rectified movement band
+    of the magnitude over the epoch, so they don't depend on fs.
+    """
+    if len(ts) == 0:
+        return np.empty((0, 2))
+    movement = np.abs(activity_filter_chain(fs)(magnitude(xyz)))
+    epoch_ms = epoch_sec * MSEC_PER_SEC
+    epoch = np.floor(np.asarray(ts) / epoch_ms).astype(np.int64)
+    starts = np.flatnonzero(np.concatenate(([True], epoch[1:] != epoch[:-1])))
+    counts = np.add.reduceat(movement.astype(np.float64), starts) / fs
+    return np.column_stack((epoch[starts] * epoch_ms, counts))
+
+def activity_summary(counts, epoch_sec=EPOCH_SEC):
+    """ Summary statistics of the rows from activity_counts() """
+    if len(counts) == 0:
+        return {"epochs": 0}
+    c = counts[:,1]
+    return {"epoch_sec": epoch_sec,
+            "epochs": len(c),
+            "mean_counts": float(np.mean(c)),
+            "max_counts": float(np.max(c)),
+            "total_counts": float(np.sum(c))}
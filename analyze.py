@@ -5,18 +5,25 @@ import sys
 import argparse
 import numpy as np
 
-from parser import is_ecg, is_ppg, is_ppg512, is_ppg125, parse_data
+from parser import is_ecg, is_ppg, is_ppg512, is_ppg125, parse_signals
 from parser import TYPE_ECG, TYPE_PPG512
+from parse_cache import load_signals, load_derived
+from pyramid import build_pyramid, pyramid_from_arrays, PYRAMID_VERSION
+from raw_index import load_index, read_window, parse_time
 from annotation import parse_annotation
-from filters import power_line_noise_filter
-from filters import high_pass_filter
-from filters import low_pass_filter
+from filters import filter_in_place
+from filters import filtfilt_padlen
+from filters import high_pass_sos
+from filters import low_pass_sos
 from plots import plot_time_domain
-from plots import plot_freq_domain
+from plots import plot_spectrum
+from spectral import SPECTRUM_KINDS
 from plots import plot_power_line_noise_filter
 from plots import plot_high_pass_filter
 from plots import plot_low_pass_filter
 from plots import plot_annotation
+from plots import plot_r_peaks
+from plots import DECIMATE_MIN_POINTS
 
 ECG_FS = 512
 PPG_FS_125 = 63 # # we skip a half data point that is ambiance
@@ -26,24 +33,48 @@ HIGH_PASS_CUTOFF = 0.5
 
 def parse_args():
     p = argparse.ArgumentParser()
+    p.add_argument('--no_cache', help='Always parse the raw data file', action='store_true')
+    p.add_argument('--start', help='Only read the samples from this time: epoch ms, '
+                   '"YYYY/MM/DD HH:MM:SS", or "HH:MM:SS" on the day the recording starts')
+    p.add_argument('--end', help='Only read the samples before this time, see --start')
+    p.add_argument('--beats', help='Mark the R peaks of ecg and print the HRV metrics', action='store_true')
+    p.add_argument('--spectrum', choices=SPECTRUM_KINDS, help='Also show the spectrum of both signals')
     p.add_argument('raw_data_file', nargs=1, help='Specify the raw data file')
     p.add_argument('annotation_file', nargs='?', help='Specify the annotation file')
     p.add_argument('start_data_point', nargs='?', help='Specify the start data point')
     p.add_argument('num_data_point', nargs='?', help='Specify the number of data point to be displayed')
     return p.parse_args()
 
-args = parse_args()
-
-f = open(args.raw_data_file[0])
-ecg_data = parse_data(f, TYPE_ECG)
+def signal_pyramid(data, signal_type, fs):
+    """
+    The pyramid of a filtered signal of the whole file, it is cached next to
+    the parsed signals, so only the first view of a long recording builds it
+    """
+    if whole_file and len(data) > DECIMATE_MIN_POINTS:
+        name = "pyramid_v%d_%d_%dHz_hp%g_lp%g" % (PYRAMID_VERSION, signal_type, fs, HIGH_PASS_CUTOFF,
+                                                  LOW_PASS_CUTOFF)
+        build = lambda: build_pyramid(data[:,0], data[:,1]).to_arrays()
+        arrays = load_derived(args.raw_data_file[0], name, build)
+        return pyramid_from_arrays(data[:,0], data[:,1], arrays)
+    return None
 
-# back to begining
-f.seek(0)
-ppg_data = parse_data(f, TYPE_PPG512)
-
-# Convert to numpy array
-ecg_data = np.array(ecg_data)
-ppg_data = np.array(ppg_data)
+args = parse_args()
+whole_file = not (args.start or args.end or args.no_cache or args.start_data_point or args.num_data_point)
+
+if args.start or args.end:
+    # look up the window in the index of the file and parse only that part
+    index = load_index(args.raw_data_file[0])
+    first_second = index.first_second()
+    start_ms = parse_time(args.start, first_second) if args.start else 0
+    end_ms = parse_time(args.end, first_second) if args.end else sys.maxsize
+    signals = read_window(args.raw_data_file[0], (TYPE_ECG, TYPE_PPG512), start_ms, end_ms, index=index)
+elif args.no_cache:
+    f = open(args.raw_data_file[0])
+    signals = parse_signals(f, (TYPE_ECG, TYPE_PPG512))
+else:
+    signals = load_signals(args.raw_data_file[0], (TYPE_ECG, TYPE_PPG512))
+ecg_data = signals[TYPE_ECG]
+ppg_data = signals[TYPE_PPG512]
 
 print ecg_data.shape
 print ppg_data.shape
@@ -59,7 +90,7 @@ if args.num_data_point:
 else:
     size = len(ecg_data)
 
-ecg_data = ecg_data[start:size]
+ecg_data = ecg_data[start:start + size]
 
 # Slice PPG data as specified
 if args.num_data_point:
@@ -67,7 +98,7 @@ if args.num_data_point:
 else:
     size = len(ppg_data)
 
-ppg_data = ppg_data[start:size]
+ppg_data = ppg_data[start:start + size]
 
 # Read annotation file
 annot = []
@@ -75,22 +106,40 @@ if args.annotation_file:
    annot_f = open(args.annotation_file)
    annot = parse_annotation(annot_f)
 
-filtered_ecg_data = ecg_data[:,1]
-filtered_ecg_data = high_pass_filter(filtered_ecg_data, ECG_FS, HIGH_PASS_CUTOFF)
-filtered_ecg_data = low_pass_filter(filtered_ecg_data, ECG_FS, LOW_PASS_CUTOFF)
-filtered_ecg_data = np.column_stack((ecg_data[:,0], filtered_ecg_data))
+ecg_sos = np.vstack((high_pass_sos(ECG_FS, HIGH_PASS_CUTOFF), low_pass_sos(ECG_FS, LOW_PASS_CUTOFF)))
+ppg_sos = np.vstack((high_pass_sos(PPG_FS_512, HIGH_PASS_CUTOFF), low_pass_sos(PPG_FS_512, LOW_PASS_CUTOFF)))
+
+# the filters run forward and backward, which needs a few samples
+for name, data, sos in (("ecg", ecg_data, ecg_sos), ("ppg", ppg_data, ppg_sos)):
+    if len(data) <= filtfilt_padlen(sos):
+        print "Too few %s samples to filter: %d, at least %d are needed. Check --start/--end " \
+              "or the data points against the time span of the file." % (name, len(data), filtfilt_padlen(sos) + 1)
+        sys.exit(1)
 
-filtered_ppg_data = ppg_data[:,1]
-filtered_ppg_data = high_pass_filter(filtered_ppg_data, PPG_FS_512, HIGH_PASS_CUTOFF)
-filtered_ppg_data = low_pass_filter(filtered_ppg_data, PPG_FS_512, LOW_PASS_CUTOFF)
-filtered_ppg_data = np.column_stack((ppg_data[:,0], filtered_ppg_data))
+filtered_ecg_data = filter_in_place(ecg_data, ecg_sos)
+filtered_ppg_data = filter_in_place(ppg_data, ppg_sos)
 
 fig = plot.figure()
 ax1 = fig.add_subplot(2, 1, 1)
 ax2 = fig.add_subplot(2, 1, 2, sharex=ax1)
-plot_time_domain(ax1, filtered_ppg_data, color='blue')
-plot_time_domain(ax2, filtered_ecg_data, color='black')
+plot_time_domain(ax1, filtered_ppg_data, color='blue',
+                 pyramid=signal_pyramid(filtered_ppg_data, TYPE_PPG512, PPG_FS_512))
+plot_time_domain(ax2, filtered_ecg_data, color='black',
+                 pyramid=signal_pyramid(filtered_ecg_data, TYPE_ECG, ECG_FS))
 plot_annotation(ax1, annot)
 plot_annotation(ax2, annot)
 
+if args.beats:
+    from hrv import analyze_ecg
+    peaks, _, metrics = analyze_ecg(filtered_ecg_data, ECG_FS)
+    plot_r_peaks(ax2, peaks)
+    print metrics
+
+if args.spectrum:
+    fig = plot.figure()
+    ax3 = fig.add_subplot(2, 1, 1)
+    ax4 = fig.add_subplot(2, 1, 2)
+    plot_spectrum(ax3, filtered_ppg_data, PPG_FS_512, args.spectrum, color='blue')
+    plot_spectrum(ax4, filtered_ecg_data, ECG_FS, args.spectrum, color='black')
+
 plot.show()
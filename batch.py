@@ -0,0 +1,185 @@
+from __future__ import print_function
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from parser import parse_signals, signal_ts
+from parser import TYPE_ACC, TYPE_ECG, TYPE_PPG512
+from parse_cache import load_signals
+from filters import ecg_filter, ppg512_filter
+from filters import ACC_FS, ECG_FS, PPG_FS_512
+from export import export_signals, EXPORT_FORMATS, SIGNAL_NAMES
+from spectral import spectral_summary
+from hrv import analyze_ecg
+from acc import acc_columns, magnitude, activity_counts, activity_summary
+
+SIGNAL_FS = {TYPE_ACC: ACC_FS, TYPE_ECG: ECG_FS, TYPE_PPG512: PPG_FS_512}
+REPORT_FILE = 'batch_report.json'
+# files in a directory that are outputs rather than raw data
+OUTPUT_EXTS = ('.csv', '.npy', '.npz', '.png', '.json')
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Process raw data files in parallel without any window')
+    p.add_argument('inputs', nargs='+', help='Raw data files, directories or glob patterns')
+    p.add_argument('--output_dir', default='.', help='Where the outputs are written')
+    p.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='Number of worker processes')
+    p.add_argument('--export', choices=EXPORT_FORMATS, help='Export the signals to csv, npy or npz files')
+    p.add_argument('--export_csv', help='Same as --export csv', action='store_true')
+    p.add_argument('--export_png', help='Export the ecg plot to png file', action='store_true')
+    p.add_argument('--no_cache', help='Always parse the raw data file', action='store_true')
+    p.add_argument('--force', help='Process files whose outputs are up to date', action='store_true')
+    opts = vars(p.parse_args())
+    if opts["export_csv"] and not opts["export"]:
+        opts["export"] = "csv"
+    return opts
+
+def find_raw_files(inputs):
+    """ Expand directories and glob patterns into a sorted list of files """
+    files = set()
+    for i in inputs:
+        if os.path.isdir(i):
+            paths = [os.path.join(i, name) for name in os.listdir(i)
+                     if os.path.splitext(name)[1] not in OUTPUT_EXTS]
+        else:
+            paths = glob.glob(i)
+        files.update(p for p in paths if os.path.isfile(p))
+    return sorted(files)
+
+def output_prefix(raw_path, output_dir):
+    basename = os.path.basename(raw_path)
+    return os.path.join(output_dir, os.path.splitext(basename)[0])
+
+def summary_path(raw_path, output_dir):
+    return output_prefix(raw_path, output_dir) + "_summary.json"
+
+def up_to_date(raw_path, opts):
+    """ The summary is written last and lists every output of the last run """
+    path = summary_path(raw_path, opts["output_dir"])
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(raw_path):
+        return False
+    f = open(path)
+    summary = json.load(f)
+    f.close()
+    if summary.get("export") != opts["export"] or summary.get("export_png") != opts["export_png"]:
+        return False
+    return all(os.path.exists(o) for o in summary.get("outputs", []))
+
+def signal_stats(data, signal_type):
+    """ Summary and spectral statistics of the value column, or of the magnitude for acc """
+    if len(data) == 0:
+        return {"samples": 0}
+    if signal_type == TYPE_ACC:
+        values = magnitude(acc_columns(data)[1])
+    else:
+        values = data[:,1]
+    ts = signal_ts(data)
+    return {"samples": len(data),
+            "start_ms": float(ts[0]),
+            "duration_ms": float(ts[-1] - ts[0]),
+            "mean": float(np.mean(values)),
+            "std": float(np.std(values)),
+            "min": float(np.min(values)),
+            "max": float(np.max(values)),
+            "spectrum": spectral_summary(values, SIGNAL_FS[signal_type])}
+
+def process_file(raw_path, opts):
+    """ Parse, filter, export and summarize one raw data file """
+    types = (TYPE_ACC, TYPE_ECG, TYPE_PPG512)
+    if opts["no_cache"]:
+        f = open(raw_path)
+        signals = parse_signals(f, types, skip_ambient=False)
+        f.close()
+    else:
+        signals = load_signals(raw_path, types, skip_ambient=False)
+
+    if len(signals[TYPE_ECG]):
+        signals[TYPE_ECG] = ecg_filter(signals[TYPE_ECG])
+    if len(signals[TYPE_PPG512]):
+        signals[TYPE_PPG512] = ppg512_filter(signals[TYPE_PPG512])
+
+    prefix = output_prefix(raw_path, opts["output_dir"])
+    outputs = []
+    if opts["export"]:
+        outputs.extend(export_signals([signals], prefix, types, opts["export"]))
+    if opts["export_png"] and len(signals[TYPE_ECG]):
+        # headless, the png is drawn on an Agg canvas without pyplot
+        from plots import render_ecg_png
+        png = prefix + ".png"
+        render_ecg_png(signals[TYPE_ECG], png)
+        outputs.append(png)
+
+    summary = {"raw_data_file": raw_path,
+               "export": opts["export"],
+               "export_png": opts["export_png"],
+               "outputs": outputs}
+    for t in types:
+        summary[SIGNAL_NAMES[t]] = signal_stats(signals[t], t)
+    if len(signals[TYPE_ACC]):
+        ts, xyz = acc_columns(signals[TYPE_ACC])
+        summary[SIGNAL_NAMES[TYPE_ACC]]["activity"] = activity_summary(activity_counts(ts, xyz, ACC_FS))
+    if len(signals[TYPE_ECG]):
+        summary[SIGNAL_NAMES[TYPE_ECG]]["hrv"] = analyze_ecg(signals[TYPE_ECG], ECG_FS)[2]
+    f = open(summary_path(raw_path, opts["output_dir"]), "w")
+    json.dump(summary, f, indent=2, sort_keys=True)
+    f.close()
+    return summary
+
+def run_one(raw_path, opts):
+    """ The worker entry, never raises so one bad file can't stop the batch """
+    start = time.time()
+    result = {"raw_data_file": raw_path}
+    try:
+        if not opts["force"] and up_to_date(raw_path, opts):
+            result["status"] = "skipped"
+        else:
+            process_file(raw_path, opts)
+            result["status"] = "ok"
+    except Exception:
+        result["status"] = "failed"
+        result["error"] = traceback.format_exc()
+    result["seconds"] = time.time() - start
+    return result
+
+def run_batch(files, opts):
+    results = []
+    executor = ProcessPoolExecutor(max_workers=max(1, opts["workers"]))
+    futures = [executor.submit(run_one, f, opts) for f in files]
+    for future in as_completed(futures):
+        r = future.result()
+        print("%-7s %8.2fs  %s" % (r["status"], r["seconds"], r["raw_data_file"]))
+        if r["status"] == "failed":
+            print(r["error"])
+        results.append(r)
+    executor.shutdown()
+    return sorted(results, key=lambda r: r["raw_data_file"])
+
+def main():
+    opts = parse_args()
+    if not os.path.exists(opts["output_dir"]):
+        os.makedirs(opts["output_dir"])
+
+    files = find_raw_files(opts["inputs"])
+    start = time.time()
+    results = run_batch(files, opts)
+    elapsed = time.time() - start
+
+    counts = dict((s, 0) for s in ("ok", "skipped", "failed"))
+    for r in results:
+        counts[r["status"]] += 1
+    print("%d files in %.2fs: %d ok, %d skipped, %d failed" %
+          (len(results), elapsed, counts["ok"], counts["skipped"], counts["failed"]))
+
+    f = open(os.path.join(opts["output_dir"], REPORT_FILE), "w")
+    json.dump({"seconds": elapsed, "counts": counts, "files": results}, f, indent=2, sort_keys=True)
+    f.close()
+    return 1 if counts["failed"] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+from __future__ import print_function
+import matplotlib
+# headless, never open a window
+matplotlib.use('Agg')
+
+import argparse
+import json
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+from synth import generate, parse_duration
+from profiling import peak_rss_mb, current_rss_mb
+
+SIZES = '1m,10m,1h'
+STAGES = ('parse_data', 'parse_data_reference', 'calc_ts', 'ecg_filter', 'ppg512_filter', 'ecg_filter_chain',
+          'plot_freq_domain', 'export_csv', 'startup')
+REPEAT = 3
+BASELINE_FILE = 'benchmark_baseline.json'
+DATA_FOLDER = os.path.join(tempfile.gettempdir(), 'bio_data_parser_bench')
+# slower than the baseline by more than this is reported as a regression
+REGRESSION_RATIO = 1.25
+# the chunk of ecg_filter_chain, like a block of parser.iter_signals()
+CHUNK_SEC = 60
+# parse_data must be this many times faster than parse_data_reference
+PARSE_SPEEDUP_TARGET = 10
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Time and memory-profile the hot paths on synthetic raw data files')
+    p.add_argument('--sizes', default=SIZES, help='Comma separated recording lengths (default: %s)' % SIZES)
+    p.add_argument('--stages', default=','.join(STAGES), help='Comma separated stages (default: all)')
+    p.add_argument('--repeat', type=int, default=REPEAT, help='Report the best of REPEAT runs')
+    p.add_argument('--data_dir', default=DATA_FOLDER, help='Where the synthetic files are kept')
+    p.add_argument('--baseline', default=BASELINE_FILE, help='The stored baseline')
+    p.add_argument('--save_baseline', help='Store the results as the new baseline', action='store_true')
+    p.add_argument('--output', help='Also write the results to this json file')
+    # internal: run one stage in a fresh process
+    p.add_argument('--run_stage', nargs=2, metavar=('STAGE', 'RAW_FILE'), help=argparse.SUPPRESS)
+    return p.parse_args()
+
+def signal_file(raw_path, signal_type):
+    return "%s.%d.npy" % (raw_path, signal_type)
+
+def reference_parse_data(file_obj):
+    """
+    The line by line ECG parse_data() parser.py started from, the
+    reference of PARSE_SPEEDUP_TARGET.
+    """
+    from parser import convert_ecg_to_mv, MSEC_PER_SEC, TYPE_ECG
+    base_ms = 0
+    buf = []
+    data = []
+    rule = re.compile("^%d," % TYPE_ECG)
+    for l in file_obj:
+        if not rule.match(l):
+            continue
+        a = l.rstrip("\n").split(',')
+        new_base_ms = int(a[15]) * MSEC_PER_SEC
+        if base_ms == 0:
+            base_ms = new_base_ms
+        elif base_ms != new_base_ms:
+            fraction = float(new_base_ms - base_ms) / len(buf)
+            for i in range(0, len(buf)):
+                ts_ms = base_ms + (fraction * i)
+                if ts_ms >= new_base_ms:
+                    print("Error: timestamp equal to or larger than new base timestamp")
+                data.append((ts_ms, buf[i]))
+            base_ms = new_base_ms
+            buf[:] = []
+        for i in a[2:13]:
+            buf.append(convert_ecg_to_mv(float(i)))
+    return data
+
+def setup_stage(stage, raw_path, work_dir):
+    """
+    Return the function to time, everything it needs is prepared here.
+    Parsed inputs are loaded from .npy files, so the setup doesn't raise
+    the memory peak above what the inputs need.
+    """
+    from parser import parse_data, calc_ts, iter_signals, TYPE_ECG, TYPE_PPG512
+    from filters import ecg_filter, ppg512_filter, ecg_filter_chain, ECG_FS
+    if stage == 'parse_data':
+        return lambda: parse_data(open(raw_path), TYPE_ECG)
+    if stage == 'parse_data_reference':
+        return lambda: reference_parse_data(open(raw_path))
+    if stage == 'export_csv':
+        from export import export_signals
+        prefix = os.path.join(work_dir, 'export')
+        return lambda: export_signals(iter_signals(open(raw_path), (TYPE_ECG,)), prefix, (TYPE_ECG,))
+    if stage == 'startup':
+        # a whole headless main.py process, on short files mostly its imports
+        main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+        cmd = [sys.executable, main_py, '--export_only', '--export', 'npy', os.path.abspath(raw_path), '5']
+        devnull = open(os.devnull, 'w')
+        return lambda: subprocess.check_call(cmd, cwd=work_dir, stdout=devnull)
+    if stage == 'ppg512_filter':
+        ppg = np.load(signal_file(raw_path, TYPE_PPG512))
+        return lambda: ppg512_filter(ppg.copy())
+
+    ecg = np.load(signal_file(raw_path, TYPE_ECG))
+    if stage == 'calc_ts':
+        # the per-second timestamps, as calc_ts() gets them
+        x = list(zip((np.floor(ecg[:,0] / 1000) * 1000).tolist(), ecg[:,1].tolist()))
+        return lambda: calc_ts(x)
+    if stage == 'ecg_filter':
+        return lambda: ecg_filter(ecg.copy())
+    if stage == 'ecg_filter_chain':
+        chunks = np.array_split(ecg, max(len(ecg) // (CHUNK_SEC * ECG_FS), 1))
+        def run():
+            chain = ecg_filter_chain(zero_phase=True)
+            out = [chain(c) for c in chunks]
+            out.append(chain.flush())
+            return out
+        return run
+    if stage == 'plot_freq_domain':
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from plots import plot_freq_domain
+        def run():
+            fig = Figure()
+            FigureCanvasAgg(fig)
+            plot_freq_domain(fig.add_subplot(1, 1, 1), ecg[:,1], ECG_FS)
+            fig.canvas.draw()
+        return run
+    raise ValueError("Unknown stage: %s" % stage)
+
+def run_stage(stage, raw_path, repeat):
+    """ Time one stage in this process, return {seconds, peak_mb} """
+    work_dir = tempfile.mkdtemp()
+    try:
+        fn = setup_stage(stage, raw_path, work_dir)
+        before = current_rss_mb()
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            fn()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        # the memory the stage needs on top of its inputs, or of its process
+        peak = max(peak_rss_mb() - before, peak_rss_mb(resource.RUSAGE_CHILDREN), 0.0)
+        return {"seconds": best, "peak_mb": peak}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def raw_file(size, data_dir):
+    """ The synthetic file of a size and its parsed signals, written once and reused """
+    from parser import parse_signals, TYPE_ECG, TYPE_PPG512
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    path = os.path.join(data_dir, "synth_%s.raw" % size)
+    if not os.path.exists(path):
+        print("generating %s" % path)
+        # one gap, so the timestamp handling of gaps is exercised too
+        seconds = parse_duration(size)
+        generate(path + ".tmp", seconds, gaps=[(seconds // 2, 5)])
+        os.rename(path + ".tmp", path)
+    if not os.path.exists(signal_file(path, TYPE_PPG512)):
+        signals = parse_signals(open(path), (TYPE_ECG, TYPE_PPG512))
+        for t in signals:
+            np.save(signal_file(path, t), signals[t])
+    return path
+
+def measure(stage, raw_path, repeat):
+    """ Run a stage in a fresh process, so its memory isn't mixed with others """
+    cmd = [sys.executable, os.path.abspath(__file__), '--repeat', str(repeat),
+           '--run_stage', stage, raw_path]
+    out = subprocess.check_output(cmd)
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+def compare(results, baseline, sizes, stages):
+    """
+    Print the results next to the baseline, return the regressions. A
+    result without a baseline counts as one, so a check can't pass
+    without comparing anything.
+    """
+    regressions = []
+    print("%-6s %-20s %10s %10s %8s %10s" % ("size", "stage", "seconds", "baseline", "ratio", "peak_mb"))
+    for size in sizes:
+        for stage in stages:
+            r = results[size][stage]
+            base = baseline.get(size, {}).get(stage)
+            if base and base["seconds"] > 0:
+                ratio = r["seconds"] / base["seconds"]
+                flag = "  REGRESSION" if ratio > REGRESSION_RATIO else ""
+                print("%-6s %-20s %10.4f %10.4f %7.2fx %10.1f%s" %
+                      (size, stage, r["seconds"], base["seconds"], ratio, r["peak_mb"], flag))
+                if flag:
+                    regressions.append((size, stage, ratio))
+            else:
+                print("%-6s %-20s %10.4f %10s %8s %10.1f  NO BASELINE" %
+                      (size, stage, r["seconds"], "-", "-", r["peak_mb"]))
+                regressions.append((size, stage, None))
+    if 'parse_data' in stages and 'parse_data_reference' in stages:
+        for size in sizes:
+            speedup = results[size]['parse_data_reference']["seconds"] / results[size]['parse_data']["seconds"]
+            flag = "" if speedup >= PARSE_SPEEDUP_TARGET else "  BELOW TARGET"
+            print("%-6s parse_data is %.1fx faster than the reference, the target is %dx%s" %
+                  (size, speedup, PARSE_SPEEDUP_TARGET, flag))
+            if flag:
+                regressions.append((size, 'parse_data', speedup))
+    return regressions
+
+def main():
+    args = parse_args()
+    if args.run_stage:
+        stage, raw_path = args.run_stage
+        print(json.dumps(run_stage(stage, raw_path, args.repeat)))
+        return 0
+
+    if not args.save_baseline and not os.path.exists(args.baseline):
+        print("no baseline in %s, store one with --save_baseline first" % args.baseline)
+        return 1
+
+    sizes = args.sizes.split(',')
+    stages = args.stages.split(',')
+    results = {}
+    for size in sizes:
+        path = raw_file(size, args.data_dir)
+        results[size] = {}
+        for stage in stages:
+            results[size][stage] = measure(stage, path, args.repeat)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        f = open(args.baseline)
+        baseline = json.load(f).get("results", {})
+        f.close()
+    regressions = compare(results, baseline, sizes, stages)
+
+    report = {"python": sys.version.split()[0], "numpy": np.__version__, "results": results}
+    if args.output:
+        f = open(args.output, "w")
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.close()
+    if args.save_baseline:
+        # keep the sizes and stages that were not run this time
+        for size in baseline:
+            for stage in baseline[size]:
+                results.setdefault(size, {}).setdefault(stage, baseline[size][stage])
+        f = open(args.baseline, "w")
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.close()
+        print("saved the baseline to %s" % args.baseline)
+    return 1 if regressions and not args.save_baseline else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
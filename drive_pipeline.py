@@ -0,0 +1,202 @@
+from __future__ import print_function
+import multiprocessing
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+NET_WORKERS = 4
+CPU_WORKERS = multiprocessing.cpu_count()
+QUEUE_SIZE = 16
+RETRIES = 3
+BACKOFF_SECOND = 1.0
+
+def with_retries(fn, retries=RETRIES, backoff=BACKOFF_SECOND):
+    """ Call fn() and retry with exponential backoff when it raises """
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception:
+            if attempt >= retries:
+                raise
+            print('retry in %.1fs:' % (backoff * (2 ** attempt)), traceback.format_exc())
+            time.sleep(backoff * (2 ** attempt))
+            attempt += 1
+
+class Checkpoint(object):
+    """
+    Save a page token only after every change listed before it has finished.
+
+    Changes are numbered in the order they are submitted. A token added by
+    add_token() covers every change numbered before it and is passed to
+    save() once none of those changes is still in flight.
+    """
+    def __init__(self, save):
+        self.save = save
+        self.lock = threading.Lock()
+        self.next_seq = 0
+        self.in_flight = set()
+        self.tokens = []
+
+    def add(self, change=None):
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self.in_flight.add(seq)
+            return seq
+
+    def add_token(self, token):
+        with self.lock:
+            self.tokens.append((self.next_seq, token))
+            self._advance()
+
+    def done(self, seq):
+        with self.lock:
+            self.in_flight.discard(seq)
+            self._advance()
+
+    def failed(self, seq):
+        """ A failed change no longer holds the token back either """
+        self.done(seq)
+
+    def _advance(self):
+        oldest = min(self.in_flight) if self.in_flight else self.next_seq
+        ready = None
+        while self.tokens and self.tokens[0][0] <= oldest:
+            ready = self.tokens.pop(0)[1]
+        if ready is not None:
+            self.save(ready)
+
+class ChangePipeline(object):
+    """
+    Download, render and upload changes concurrently.
+
+    make_service: Return a Drive service, called once per network thread
+                  because the http object of a service is not thread-safe
+    download:     download(service, change) -> raw data
+    render:       render(raw data, change) -> (local png path, remote name),
+                  runs in a worker process so it must be a module-level function
+    upload:       upload(service, local png path, remote name)
+    checkpoint:   The Checkpoint told about every submitted, finished and
+                  failed change
+    cache:        Optional, cache.lookup(change, raw data=None) returns the
+                  (local png path, remote name) of content rendered before
+                  or None, and cache.store(raw data, png) keeps a rendered png
+
+    A change whose content is in the cache skips the render, and the
+    download too when the cache knows the content from the change alone.
+    Every stage reads from a bounded queue, so submit() blocks when the
+    pipeline is full. Network calls are retried with exponential backoff.
+    A change that still fails is reported and passed to checkpoint.failed()
+    instead of checkpoint.done(), so it can't hold the checkpoint back
+    forever but isn't recorded as processed either.
+    """
+    def __init__(self, make_service, download, render, upload, checkpoint,
+                 net_workers=NET_WORKERS, cpu_workers=CPU_WORKERS, queue_size=QUEUE_SIZE,
+                 retries=RETRIES, backoff=BACKOFF_SECOND, cache=None):
+        self.make_service = make_service
+        self.download = download
+        self.render = render
+        self.upload = upload
+        self.checkpoint = checkpoint
+        self.cache = cache
+        self.net_workers = net_workers
+        self.cpu_workers = cpu_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.download_q = queue.Queue(queue_size)
+        self.render_q = queue.Queue(queue_size)
+        self.upload_q = queue.Queue(queue_size)
+        self.failed = []
+        self.pool = None
+        self.stages = []
+
+    def start(self):
+        self.pool = ProcessPoolExecutor(max_workers=self.cpu_workers)
+        self.stages = [(self.download_q, self._start_threads(self._download_worker, self.net_workers)),
+                       (self.render_q, self._start_threads(self._render_worker, self.cpu_workers)),
+                       (self.upload_q, self._start_threads(self._upload_worker, self.net_workers))]
+
+    def submit(self, change):
+        seq = self.checkpoint.add(change)
+        self.download_q.put((seq, change))
+
+    def close(self):
+        """ Finish every submitted change, then stop the workers """
+        for q, threads in self.stages:
+            for _ in threads:
+                q.put(None)
+            for t in threads:
+                t.join()
+        self.pool.shutdown()
+
+    def _start_threads(self, target, n):
+        threads = []
+        for _ in range(n):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        return threads
+
+    def _fail(self, seq, change, stage):
+        print('failed to %s:' % stage, change, traceback.format_exc())
+        self.failed.append((change, stage))
+        self.checkpoint.failed(seq)
+
+    def _download_worker(self):
+        service = self.make_service()
+        while True:
+            item = self.download_q.get()
+            if item is None:
+                break
+            seq, change = item
+            png = self.cache.lookup(change) if self.cache else None
+            if png is not None:
+                self.upload_q.put((seq, change, png))
+                continue
+            try:
+                data = with_retries(lambda: self.download(service, change), self.retries, self.backoff)
+            except Exception:
+                self._fail(seq, change, 'download')
+                continue
+            self.render_q.put((seq, change, data))
+
+    def _render_worker(self):
+        while True:
+            item = self.render_q.get()
+            if item is None:
+                break
+            seq, change, data = item
+            png = self.cache.lookup(change, data) if self.cache else None
+            if png is not None:
+                self.upload_q.put((seq, change, png))
+                continue
+            try:
+                png = self.pool.submit(self.render, data, change).result()
+                if self.cache:
+                    self.cache.store(data, png)
+            except Exception:
+                self._fail(seq, change, 'render')
+                continue
+            self.upload_q.put((seq, change, png))
+
+    def _upload_worker(self):
+        service = self.make_service()
+        while True:
+            item = self.upload_q.get()
+            if item is None:
+                break
+            seq, change, (local_png_path, png_name) = item
+            try:
+                with_retries(lambda: self.upload(service, local_png_path, png_name), self.retries, self.backoff)
+            except Exception:
+                self._fail(seq, change, 'upload')
+                continue
+            self.checkpoint.done(seq)
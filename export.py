@@ -0,0 +1,257 @@
+import os
+import struct
+import threading
+import zipfile
+import numpy as np
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from parser import TYPE_ACC, TYPE_ECG, TYPE_PPG125, TYPE_PPG512, empty_signal, signal_dtype
+
+EXPORT_FORMATS = ('csv', 'npy', 'npz')
+SIGNAL_NAMES = {TYPE_ACC: 'acc', TYPE_ECG: 'ecg', TYPE_PPG125: 'ppg125', TYPE_PPG512: 'ppg'}
+
+# the default format of np.savetxt, so csv files don't change
+CSV_FMT = '%.18e'
+# rows formatted at a time
+CSV_CHUNK_ROWS = 65536
+
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+# room for the header of any 2-d shape, a multiple of 64 as numpy aligns it
+NPY_HEADER_SIZE = 128
+# chunks the writer of a type may fall behind the parsing
+EXPORT_QUEUE_SIZE = 4
+
+def flat_rows(data):
+    """ The rows of a structured array, e.g. [timestamp, x, y, z] rows of the acc samples """
+    return np.column_stack([data[name].reshape(len(data), -1) for name in data.dtype.names])
+
+class CsvWriter(object):
+    """
+    Write rows to a csv file chunk by chunk, like np.savetxt(delimiter=',').
+    The fields of a structured array, e.g. of the acc samples, are
+    written as columns.
+
+    A whole block of rows is formatted by a single % operation instead of
+    one Python call per row, which makes it several times faster.
+    """
+    def __init__(self, path, fmt=CSV_FMT):
+        self.path = path
+        self.fmt = fmt
+        self.line_fmt = None
+        self.f = open(path, 'w')
+
+    def write(self, data):
+        data = np.asarray(data)
+        if len(data) == 0:
+            return
+        if data.dtype.names:
+            data = flat_rows(data)
+        if data.ndim == 1:
+            data = data[:,np.newaxis]
+        if self.line_fmt is None:
+            self.line_fmt = ','.join([self.fmt] * data.shape[1]) + '\n'
+        for i in range(0, len(data), CSV_CHUNK_ROWS):
+            rows = data[i:i + CSV_CHUNK_ROWS]
+            self.f.write((self.line_fmt * len(rows)) % tuple(rows.ravel().tolist()))
+
+    def close(self):
+        self.f.close()
+
+class NpyWriter(object):
+    """
+    Append rows to a .npy file chunk by chunk.
+
+    Room for the header is reserved first and the header is written on
+    close(), once the number of rows is known. The file can be read back
+    with np.load(), or memory-mapped with mmap_mode='r'.
+
+    The dtype and the columns are taken from the first chunk that has rows.
+    A later chunk that doesn't fit the dtype, e.g. acc samples that need
+    int32, widens the rows written so far. A file without rows gets the
+    dtype and the columns of `empty`, or float64 when it is None.
+    """
+    def __init__(self, path, empty=None):
+        self.path = path
+        self.dtype = None
+        self.columns = None
+        self.empty = np.empty(0) if empty is None else empty
+        self.rows = 0
+        self.f = open(path, 'w+b')
+        self.f.write(b'\0' * NPY_HEADER_SIZE)
+
+    def write(self, data):
+        data = np.asarray(data)
+        if len(data) == 0:
+            return
+        if self.dtype is None:
+            self.dtype = data.dtype
+            self.columns = data.shape[1:]
+        if data.shape[1:] != self.columns:
+            raise ValueError("expect rows of shape %s, got %s" % (self.columns, data.shape[1:]))
+        dtype = signal_dtype((self.dtype, data.dtype))
+        if dtype != self.dtype:
+            self.widen(dtype)
+        self.f.write(np.ascontiguousarray(data, dtype=self.dtype).tobytes())
+        self.rows += len(data)
+
+    def widen(self, dtype):
+        """ Rewrite the rows written so far as dtype """
+        self.f.seek(NPY_HEADER_SIZE)
+        written = np.fromfile(self.f, dtype=self.dtype, count=self.rows * int(np.prod(self.columns)))
+        self.f.seek(NPY_HEADER_SIZE)
+        self.f.write(written.astype(dtype).tobytes())
+        self.dtype = dtype
+
+    def header(self):
+        dtype = self.dtype if self.dtype is not None else self.empty.dtype
+        columns = self.columns if self.columns is not None else self.empty.shape[1:]
+        shape = (self.rows,) + tuple(columns)
+        d = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+            np.lib.format.dtype_to_descr(dtype), tuple(int(n) for n in shape))
+        size = NPY_HEADER_SIZE - len(NPY_MAGIC) - 2
+        return NPY_MAGIC + struct.pack('<H', size) + d.ljust(size - 1).encode('latin1') + b'\n'
+
+    def close(self):
+        self.f.seek(0)
+        self.f.write(self.header())
+        self.f.close()
+
+class SignalExporter(object):
+    """
+    Export the signals of one recording chunk by chunk.
+
+    prefix:       The outputs are <prefix>_<name>.csv or .npy, or one
+                  <prefix>.npz that holds a <name> array per signal
+    signal_types: The exported signal types
+    fmt:          "csv", "npy" or "npz" (compressed)
+    """
+    def __init__(self, prefix, signal_types, fmt='csv'):
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError("Unknown export format: %s" % fmt)
+        self.prefix = prefix
+        self.signal_types = signal_types
+        self.fmt = fmt
+        self.writers = {}
+        for t in signal_types:
+            if fmt == 'csv':
+                self.writers[t] = CsvWriter("%s_%s.csv" % (prefix, SIGNAL_NAMES[t]))
+            else:
+                self.writers[t] = NpyWriter("%s_%s.npy" % (prefix, SIGNAL_NAMES[t]), empty_signal(t))
+
+    def write(self, chunk):
+        """ chunk: {signal_type: numpy array} """
+        for t in self.signal_types:
+            if t in chunk:
+                self.writers[t].write(chunk[t])
+
+    def close(self):
+        """ Return the paths of the outputs """
+        paths = []
+        for t in self.signal_types:
+            self.writers[t].close()
+            paths.append(self.writers[t].path)
+        if self.fmt != 'npz':
+            return paths
+
+        # the .npy files are streamed into the archive from disk
+        npz = self.prefix + ".npz"
+        z = zipfile.ZipFile(npz, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        for t, path in zip(self.signal_types, paths):
+            z.write(path, SIGNAL_NAMES[t] + ".npy")
+        z.close()
+        for path in paths:
+            os.remove(path)
+        return [npz]
+
+def export_signals(chunks, prefix, signal_types, fmt='csv', filters=None):
+    """
+    chunks:       {signal_type: numpy array} chunks, e.g. from parser.iter_signals()
+    prefix:       See SignalExporter
+    signal_types: The exported signal types
+    fmt:          "csv", "npy" or "npz"
+    filters:      Optional {signal_type: filters.FilterChain} applied on the way
+    return:       The paths of the outputs
+
+    The chunks are parsed on the calling thread while every type is
+    filtered and written by a thread of its own, so the types are exported
+    concurrently with each other and with the parsing of the next chunk.
+    Only a few chunks of every signal are held in memory at a time.
+    """
+    filters = filters or {}
+    exporter = SignalExporter(prefix, signal_types, fmt)
+    queues = dict((t, queue.Queue(EXPORT_QUEUE_SIZE)) for t in signal_types)
+    errors = []
+    threads = [threading.Thread(target=export_worker, args=(exporter.writers[t], queues[t], filters.get(t), errors))
+               for t in signal_types]
+    for th in threads:
+        th.daemon = True
+        th.start()
+    try:
+        for chunk in chunks:
+            if errors:
+                break
+            for t in signal_types:
+                if t in chunk:
+                    queues[t].put(chunk[t])
+    finally:
+        for t in signal_types:
+            queues[t].put(None)
+        for th in threads:
+            th.join()
+        paths = exporter.close()
+    if errors:
+        raise errors[0]
+    return paths
+
+def export_worker(writer, chunks, chain, errors):
+    """ Filter and write the chunks of one type from a queue until None """
+    try:
+        while True:
+            data = chunks.get()
+            if data is None:
+                break
+            writer.write(chain(data) if chain is not None else data)
+        if chain is not None:
+            rest = chain.flush()
+            if len(rest):
+                writer.write(rest)
+    except Exception as e:
+        errors.append(e)
+        # keep taking chunks so the parsing isn't blocked on a full queue
+        while chunks.get() is not None:
+            pass
+
+def write_filtered(exporter, chunk, filters):
+    """ Write a chunk to a SignalExporter through {signal_type: filters.FilterChain} """
+    out = {}
+    for t in exporter.signal_types:
+        if t in chunk:
+            out[t] = filters[t](chunk[t]) if t in filters else chunk[t]
+    exporter.write(out)
+
+def flush_filters(exporter, filters):
+    """ Write what the filters of write_filtered() still hold back """
+    for t, chain in filters.items():
+        rest = chain.flush()
+        if t in exporter.signal_types and len(rest):
+            exporter.write({t: rest})
+
+def load_export(path):
+    """
+    Read an exported file back without parsing the raw data again.
+    .npy files are memory-mapped read-only, .npz files return
+    {name: numpy array} and csv files a 2-d numpy array.
+    """
+    ext = os.path.splitext(path)[1]
+    if ext == '.npy':
+        return np.load(path, mmap_mode='r')
+    if ext == '.npz':
+        z = np.load(path)
+        signals = dict((name, z[name]) for name in z.files)
+        z.close()
+        return signals
+    return np.loadtxt(path, delimiter=',', ndmin=2)
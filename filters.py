@@ -1,4 +1,3 @@
-import scipy
 import numpy as np
 from scipy import signal
 
@@ -10,24 +9,196 @@ PPG_FS_512 = 512 # don't skip any received data, ambient data has been skipped b
 LOW_PASS_CUTOFF = 35
 HIGH_PASS_CUTOFF = 0.5
 
+POWER_LINE_FREQ = 65.0
+POWER_LINE_Q = 30.0
+FILTER_ORDER = 3
+
+# context kept on both sides of a block in zero-phase mode
+ZERO_PHASE_OVERLAP_SEC = 10
+
+# memoized filter designs, see design_sos()
+sos_cache = {}
+
+def design_sos(btype, order, cutoff, fs):
+    """
+    btype:  "notch", "highpass" or "lowpass"
+    order:  The order of the butterworth filter, ignored by "notch"
+    cutoff: The cutoff frequency, or the notched frequency (Hz)
+    fs:     The sampling rate (Hz)
+    return: The filter in second-order sections
+
+    The design is computed once per (btype, order, cutoff, fs) and shared,
+    so the returned array is read-only.
+    """
+    key = (btype, order, cutoff, fs)
+    sos = sos_cache.get(key)
+    if sos is None:
+        normalized_cutoff = cutoff / (fs / 2.0)
+        if btype == "notch":
+            b, a = signal.iirnotch(normalized_cutoff, POWER_LINE_Q)
+            sos = signal.tf2sos(b, a)
+        else:
+            sos = signal.butter(order, normalized_cutoff, btype=btype, analog=False, output='sos')
+        sos.flags.writeable = False
+        sos_cache[key] = sos
+    return sos
+
+def power_line_noise_sos(fs):
+    return design_sos("notch", 2, POWER_LINE_FREQ, fs)
+
+def high_pass_sos(fs, cutoff):
+    return design_sos("highpass", FILTER_ORDER, cutoff, fs)
+
+def low_pass_sos(fs, cutoff):
+    return design_sos("lowpass", FILTER_ORDER, cutoff, fs)
+
 def power_line_noise_filter(data, fs):
-    f0 = 65.0
-    Q = 30.0
-    w0 = f0 / (fs/2)
-    b, a = signal.iirnotch(w0, Q)
-    return scipy.signal.filtfilt(b, a, data)
+    return signal.sosfiltfilt(power_line_noise_sos(fs), data)
 
 def high_pass_filter(data, fs, cutoff):
-    nyq = fs / 2.0
-    normalized_cutoff = cutoff / nyq
-    b, a = signal.butter(3, normalized_cutoff, btype="highpass", analog=False)
-    return scipy.signal.filtfilt(b, a, data)
+    return signal.sosfiltfilt(high_pass_sos(fs, cutoff), data)
 
 def low_pass_filter(data, fs, cutoff):
-    nyq = fs / 2.0
-    normalized_cutoff = cutoff / nyq
-    b, a = signal.butter(3, normalized_cutoff, btype="lowpass", analog=False)
-    return scipy.signal.filtfilt(b, a, data)
+    return signal.sosfiltfilt(low_pass_sos(fs, cutoff), data)
+
+def filter_in_place(x, sos):
+    """
+    Filter the value column of [timestamp, value] rows forward and backward
+    with the whole cascade at once. The result is written back into x, a
+    read-only x (e.g. from parse_cache) is copied once first.
+    """
+    if not x.flags.writeable:
+        x = x.copy()
+    x[:,1] = signal.sosfiltfilt(sos, x[:,1])
+    return x
+
+def ecg_sos():
+    """ The power line noise, high pass and low pass filters of ecg data """
+    return np.vstack((power_line_noise_sos(ECG_FS),
+                      high_pass_sos(ECG_FS, HIGH_PASS_CUTOFF),
+                      low_pass_sos(ECG_FS, LOW_PASS_CUTOFF)))
+
+def ppg512_sos():
+    """ The high pass and low pass filters of ppg512 data """
+    return np.vstack((high_pass_sos(PPG_FS_512, HIGH_PASS_CUTOFF),
+                      low_pass_sos(PPG_FS_512, LOW_PASS_CUTOFF)))
+
+def ecg_filter(x):
+    """ A map function to perform all filters against ecg data in place
+    Input: numpy array
+    Output: numpy array
+    """
+    return filter_in_place(x, ecg_sos())
+
+def ppg512_filter(x):
+    """ A map function to perform all filters against ppg512 data in place
+    Input: numpy array
+    Output: numpy array
+    """
+    return filter_in_place(x, ppg512_sos())
+
+class FilterChain(object):
+    """
+    A cascade of filters that is fed chunks one after another.
+
+    By default the chunks are filtered causally with scipy.signal.sosfilt and
+    the filter state is carried from one chunk to the next, so the output is
+    continuous across chunk edges and each call costs O(chunk).
+
+    With zero_phase=True every block is filtered forward and backward with
+    `overlap` samples of context on both sides, like filtfilt. The output
+    then lags the input by `overlap` samples, call flush() at the end to get
+    the rest.
+
+    Chunks are numpy arrays of values or of [timestamp, value] rows. The
+    object can be used as a map function, e.g. Observable.map(chain).
+    """
+    def __init__(self, sos_list, zero_phase=False, overlap=0):
+        self.sos = np.vstack(sos_list)
+        self.zero_phase = zero_phase
+        self.overlap = overlap
+        self.reset()
+
+    def reset(self):
+        self.zi = None
+        self.history = None
+        self.pending = None
+
+    def __call__(self, x):
+        return self.process(x)
+
+    def process(self, x):
+        x = np.asarray(x)
+        if self.zero_phase:
+            return self._process_zero_phase(x)
+        if len(x) == 0:
+            return x
+        values = values_of(x)
+        if self.zi is None:
+            # start from the steady state of the first sample
+            self.zi = signal.sosfilt_zi(self.sos) * values[0]
+        filtered, self.zi = signal.sosfilt(self.sos, values, zi=self.zi)
+        return with_values(x, filtered)
+
+    def flush(self):
+        """ Return what zero-phase mode still holds back, then reset """
+        if not self.zero_phase or self.pending is None or len(self.pending) == 0:
+            self.reset()
+            return np.empty((0,))
+        ext = concat(self.history, self.pending)
+        filtered = self._filtfilt(values_of(ext))
+        out = with_values(self.pending, filtered[len(ext) - len(self.pending):])
+        self.reset()
+        return out
+
+    def _process_zero_phase(self, x):
+        self.pending = concat(self.pending, x)
+        if len(self.pending) <= self.overlap:
+            return self.pending[:0]
+
+        split = len(self.pending) - self.overlap
+        ready = self.pending[:split]
+        ext = concat(self.history, self.pending)
+        start = len(ext) - len(self.pending)
+        filtered = self._filtfilt(values_of(ext))
+        out = with_values(ready, filtered[start:start + split])
+
+        self.history = concat(self.history, ready)[-self.overlap:] if self.overlap else None
+        self.pending = self.pending[split:]
+        return out
+
+    def _filtfilt(self, values):
+        # the default padlen of sosfiltfilt, shortened for tiny inputs
+        padlen = min(filtfilt_padlen(self.sos), len(values) - 1)
+        return signal.sosfiltfilt(self.sos, values, padlen=padlen)
+
+def filtfilt_padlen(sos):
+    """ The default padlen of sosfiltfilt(), it needs more samples than this """
+    zeros = min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum())
+    return 3 * (2 * len(sos) + 1 - zeros)
+
+def values_of(x):
+    if x.ndim == 2:
+        return x[:,1]
+    return x
+
+def with_values(x, filtered):
+    if x.ndim == 2:
+        return np.column_stack((x[:,0], filtered))
+    return filtered
+
+def concat(a, b):
+    if a is None or len(a) == 0:
+        return b
+    return np.concatenate((a, b))
+
+def ecg_filter_chain(zero_phase=False):
+    """ A FilterChain of the filters of ecg_filter() """
+    return FilterChain([ecg_sos()], zero_phase, ZERO_PHASE_OVERLAP_SEC * ECG_FS)
+
+def ppg512_filter_chain(zero_phase=False):
+    """ A FilterChain of the filters of ppg512_filter() """
+    return FilterChain([ppg512_sos()], zero_phase, ZERO_PHASE_OVERLAP_SEC * PPG_FS_512)
 
 def ppg512_pl_filter(x):
     """ A map function to perform power line noise filter against ppg512 data
@@ -75,7 +246,7 @@ def ecg_hp_filter(x):
     Output: numpy array
     """
     filtered = x[:,1]
-    filtered = high_pass_filter(filtered, PPG_FS_512, HIGH_PASS_CUTOFF)
+    filtered = high_pass_filter(filtered, ECG_FS, HIGH_PASS_CUTOFF)
     filtered = np.column_stack((x[:,0], filtered))
     return filtered
 
@@ -85,7 +256,7 @@ def ecg_lp_filter(x):
     Output: numpy array
     """
     filtered = x[:,1]
-    filtered = low_pass_filter(filtered, PPG_FS_512, LOW_PASS_CUTOFF)
+    filtered = low_pass_filter(filtered, ECG_FS, LOW_PASS_CUTOFF)
     filtered = np.column_stack((x[:,0], filtered))
     return filtered
 
@@ -97,9 +268,9 @@ def acc_mag_filter(x):
 def acc_flat(x):
     """ A map function to simply the acc data format
     Input: list, e.g. [(timestamp, (x, y, z))]
-    Output: list, e.g. [[timestamp, x, y, z]]
+    Output: numpy array, e.g. [[timestamp, x, y, z]]
     """
-    y = []
-    for i in x:
-        y.append([i[0], i[1][0], i[1][1], i[1][2]])
-    return y
+    if len(x) == 0:
+        return np.empty((0, 4))
+    ts, xyz = zip(*x)
+    return np.column_stack((ts, xyz))
@@ -0,0 +1,84 @@
+import os
+import time
+
+from parser import SignalDecoder, decode_signal, to_text, ALL_TYPES, BLOCK_SIZE
+from raw_index import head_digest, HEAD_SIZE
+
+# seconds between looking at the size of the file
+FOLLOW_INTERVAL_SEC = 1.0
+
+class RawFollower(object):
+    """
+    Parse a raw data file that keeps growing, e.g. during a live recording.
+
+    The checkpoint between updates is the byte offset after the last whole
+    line consumed and the rows of the last second of every type, whose
+    timestamps can't be interpolated before the next second shows up. An
+    update only reads and decodes what was appended after the offset, so
+    it costs what was appended, not the size of the file. A line still
+    being written is left for the next update.
+
+    A file that shrank or whose first bytes changed has been replaced and
+    is followed again from the start. on_replaced() is called then, so the
+    state kept by the caller about the old file can be dropped too.
+    """
+    def __init__(self, raw_path, signal_types=ALL_TYPES, skip_ambient=True, block_size=BLOCK_SIZE,
+                 on_replaced=None):
+        self.raw_path = raw_path
+        self.signal_types = signal_types
+        self.skip_ambient = skip_ambient
+        self.block_size = block_size
+        self.on_replaced = on_replaced
+        self.reset()
+
+    def reset(self):
+        decode = lambda rows, t: decode_signal(rows, t, self.skip_ambient)
+        self.decoder = SignalDecoder(self.signal_types, decode)
+        self.offset = 0
+        # the digest of the first head_size bytes
+        self.head = None
+        self.head_size = 0
+
+    def replaced(self, size):
+        if size < self.offset:
+            return True
+        return self.head is not None and head_digest(self.raw_path, self.head_size) != self.head
+
+    def update(self):
+        """ Return the {signal_type: numpy array} chunks of what was appended since the last update """
+        size = os.path.getsize(self.raw_path)
+        if self.replaced(size):
+            self.reset()
+            if self.on_replaced is not None:
+                self.on_replaced()
+        chunks = []
+        if size == self.offset:
+            return chunks
+
+        f = open(self.raw_path, 'rb')
+        f.seek(self.offset)
+        while True:
+            block = f.read(self.block_size)
+            end = block.rfind(b'\n') + 1
+            if end == 0:
+                # the end, or a line still being written
+                break
+            chunks.append(self.decoder.feed(to_text(block[:end])))
+            self.offset += end
+            f.seek(self.offset)
+        f.close()
+
+        if self.head_size < HEAD_SIZE and self.offset > self.head_size:
+            self.head_size = min(self.offset, HEAD_SIZE)
+            self.head = head_digest(self.raw_path, self.head_size)
+        return chunks
+
+def follow(raw_path, signal_types=ALL_TYPES, skip_ambient=True, interval=FOLLOW_INTERVAL_SEC):
+    """ Yield the chunks of a RawFollower as the file grows, forever """
+    follower = RawFollower(raw_path, signal_types, skip_ambient)
+    while True:
+        chunks = follower.update()
+        for chunk in chunks:
+            yield chunk
+        if not chunks:
+            time.sleep(interval)
@@ -1,33 +1,23 @@
 from __future__ import print_function
-import httplib2
+import hashlib
 import os
+import shutil
+import tempfile
 import time
+import threading
 import io
 
-from apiclient import discovery
-from apiclient.http import MediaIoBaseDownload, MediaFileUpload
-from oauth2client import client
-from oauth2client import tools
-from oauth2client.file import Storage
+# the Google API client is imported by the functions that use it, so that
+# --watch_dir and the rendering processes start without it
+from parser import TYPE_ECG
+from parse_cache import load_signals_from_file_obj
+from filters import ecg_filter
+from plots import render_ecg_png
+from drive_pipeline import ChangePipeline, Checkpoint, NET_WORKERS, CPU_WORKERS
+from local_watch import LocalSource, ProcessedRecord
 
-from parser import is_ecg, parse_data, TYPE_ECG
-from filters import power_line_noise_filter
-from filters import high_pass_filter
-from filters import low_pass_filter
-from plots import plot_ecg, plot_to_png
-
-import numpy as np
-import matplotlib.pyplot as plot
-
-ECG_FS = 512
-LOW_PASS_CUTOFF = 35
-HIGH_PASS_CUTOFF = 0.5
-
-try:
-    import argparse
-    flags = argparse.ArgumentParser(parents=[tools.argparser]).parse_args()
-except ImportError:
-    flags = None
+# parsed in main() so that importing this module has no side effects
+flags = None
 
 # If modifying these scopes, delete your previously saved credentials
 # at ~/.credentials/drive-python-quickstart.json
@@ -39,10 +29,46 @@ MONITOR_FOLDER_ID = '1JhRkeKNactLp40gmVUSUMKklB5LJwx7j'
 PNG_FOLDER_ID = '1G0pFjG8pp1qG2KxcnE-xIZ64CuKeRkGW'
 POLLING_CHANGES_SECOND = 45
 CACHE_FOLDER = '.cache'
+# rendered pngs by the md5 of their raw data, so identical recordings
+# under other names or file ids are rendered once
+PNG_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'png')
+# prefix of the pngs still being written
+PNG_TMP_PREFIX = '.tmp'
+# file id -> md5Checksum of the Drive files processed
+DRIVE_PROCESSED_FILE = 'processed_drive_files.json'
+# polls a failed change is submitted again on, the Changes API won't list
+# it again once the page token has moved past it
+FAILED_POLL_RETRIES = 3
+CHANGES_PAGE_SIZE = 1000
+# ask changes().list for what filter_changes() needs instead of one get per change
+CHANGES_FIELDS = 'nextPageToken,newStartPageToken,changes(fileId,removed,file(id,name,trashed,parents,md5Checksum))'
+# the limit of requests in one batch of the Drive API
+BATCH_SIZE = 100
+
+# file id -> whether it is in MONITOR_FOLDER_ID
+folder_membership = {}
+
+def parse_flags():
+    try:
+        import argparse
+        from oauth2client import tools
+        p = argparse.ArgumentParser(parents=[tools.argparser])
+        p.add_argument('--net_workers', type=int, default=NET_WORKERS,
+                       help='Number of download and upload threads each')
+        p.add_argument('--cpu_workers', type=int, default=CPU_WORKERS,
+                       help='Number of rendering processes')
+        p.add_argument('--watch_dir', help='Watch a local directory instead of Google Drive')
+        p.add_argument('--output_dir', default=CACHE_FOLDER,
+                       help='Where the png files are saved in --watch_dir mode')
+        return p.parse_args()
+    except ImportError:
+        return None
 
 def create_cache_dir():
     if not os.path.exists(CACHE_FOLDER):
        os.makedirs(CACHE_FOLDER)
+    if not os.path.exists(PNG_CACHE_FOLDER):
+       os.makedirs(PNG_CACHE_FOLDER)
 
 def get_credentials():
     """Gets valid user credentials from storage.
@@ -60,6 +86,9 @@ def get_credentials():
     credential_path = os.path.join(credential_dir,
                                    'drive-python-quickstart.json')
 
+    from oauth2client import client
+    from oauth2client import tools
+    from oauth2client.file import Storage
     store = Storage(credential_path)
     credentials = store.get()
     if not credentials or credentials.invalid:
@@ -101,7 +130,8 @@ def list_changes(service, token):
     """ Return changes and newStartPageToken """
     start = token
     while True:
-        resp = service.changes().list(pageToken=start, spaces='drive').execute()
+        resp = service.changes().list(pageToken=start, spaces='drive', pageSize=CHANGES_PAGE_SIZE,
+                                      fields=CHANGES_FIELDS).execute()
         yield (resp.get('changes'), resp.get('newStartPageToken'))
 
         if resp.get('nextPageToken'):
@@ -109,22 +139,59 @@ def list_changes(service, token):
         if resp.get('newStartPageToken'):
             break;
 
+def in_monitor_folder(f):
+    parents = f.get('parents')
+    return bool(parents) and parents[0] == MONITOR_FOLDER_ID
+
+def fetch_parents(service, file_ids):
+    """ Return {file id: file resource with trashed and parents} in batched requests """
+    found = {}
+    def callback(request_id, resp, exception):
+        if exception is None:
+            found[resp.get('id')] = resp
+        else:
+            print('failed to get parents: ', request_id, exception)
+
+    for i in range(0, len(file_ids), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=callback)
+        for file_id in file_ids[i:i + BATCH_SIZE]:
+            batch.add(service.files().get(fileId=file_id, fields='id,trashed,parents'), request_id=file_id)
+        batch.execute()
+    return found
+
 def filter_changes(service, token):
-    """ Return (trashed, change, newStartPageToken) """
+    """ Return (trashed, change, newStartPageToken)
+
+    The parents come with the changes. Files listed without them are looked
+    up in batches, and the folder membership is remembered by file id.
+    A final (False, None, newStartPageToken) is returned so the token
+    advances even if no change is in the monitored folder.
+    """
+    new = None
     for changes, new in list_changes(service, token):
+        files = [c.get('file') for c in changes if c.get('file')]
+        unknown = [f.get('id') for f in files
+                   if f.get('parents') is None and f.get('id') not in folder_membership]
+        fetched = fetch_parents(service, unknown)
+
         for c in changes:
-            if c.get('file'):
-                ignore = False
-                # check if the parent directoy is what we want
-                resp = service.files().get(fileId=c.get('file').get('id'), fields='trashed,parents').execute()
-                if resp.get('parents') and resp.get('parents')[0] == MONITOR_FOLDER_ID:
-                    if resp.get('trashed'):
-                        # ignore those files moved to trash can
-                        yield True, c, new
-                    else:
-                        yield False, c, new
+            f = c.get('file')
+            if not f:
+                continue
+            f = fetched.get(f.get('id'), f)
+            if f.get('parents') is not None:
+                folder_membership[f.get('id')] = in_monitor_folder(f)
+            # check if the parent directoy is what we want
+            if folder_membership.get(f.get('id')):
+                if f.get('trashed'):
+                    # ignore those files moved to trash can
+                    yield True, c, new
+                else:
+                    yield False, c, new
+    yield False, None, new
 
 def download_file(service, file_id):
+    from apiclient.http import MediaIoBaseDownload
     req = service.files().get_media(fileId=file_id)
     f = io.BytesIO()
     downloader = MediaIoBaseDownload(f, req)
@@ -137,60 +204,230 @@ def download_file(service, file_id):
     return f
 
 def upload_png(service, local_file_path, remote_file_name):
+    from apiclient.http import MediaFileUpload
     file_metadata = {'name': remote_file_name,
                      'parents': [PNG_FOLDER_ID]}
     media = MediaFileUpload(local_file_path, mimetype='image/png')
     resp = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
     print('Uploaded: ', resp)
 
-def process(service, change):
-    # debug
-    print(change)
-    # prepare png name
-    file_name = change.get('file').get('name')
-    png_name = os.path.splitext(file_name)[0] + '.png'
-    local_png_path = os.path.join(CACHE_FOLDER, png_name)
-    # download from upstream
+def download_change(service, change):
+    """ Return the raw data of the changed file """
     f = download_file(service, change.get('file').get('id'))
+    return f.getvalue()
+
+def png_name_of(change):
+    file_name = change.get('file').get('name')
+    return os.path.splitext(file_name)[0] + '.png'
+
+def png_path_of(raw, folder=PNG_CACHE_FOLDER):
+    """ The png of raw data is kept by its md5, changes of other content never share it """
+    return os.path.join(folder, hashlib.md5(raw).hexdigest() + '.png')
+
+def write_png(path, write):
+    """
+    Call write() with a unique temporary path next to `path` and rename
+    the file into place, so a png being written is never read or
+    overwritten by another worker
+    """
+    fd, tmp = tempfile.mkstemp(prefix=PNG_TMP_PREFIX, suffix='.png', dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        write(tmp)
+        os.rename(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def render_change(raw, change):
+    """ Parse, filter and plot the raw data of a change, return (local png path, png name) """
+    png_name = png_name_of(change)
+    local_png_path = png_path_of(raw)
     # parse
-    data = parse_data(f, TYPE_ECG)
-    data = np.array(data)
+    data = load_signals_from_file_obj(io.BytesIO(raw), (TYPE_ECG,))[TYPE_ECG]
     # filter
-    filtered = data[:,1]
-    filtered = power_line_noise_filter(filtered, ECG_FS)
-    filtered = high_pass_filter(filtered, ECG_FS, HIGH_PASS_CUTOFF)
-    filtered = low_pass_filter(filtered, ECG_FS, LOW_PASS_CUTOFF)
-    filtered = np.column_stack((data[:,0], filtered))
+    filtered = ecg_filter(data)
     # save to png
-    plot_ecg(filtered)
-    plot_to_png(local_png_path)
-    # upload
+    write_png(local_png_path, lambda path: render_ecg_png(filtered, path))
+    return local_png_path, png_name
+
+def process(service, change):
+    """ Process one change from download to upload in the calling thread """
+    # debug
+    print(change)
+    local_png_path, png_name = render_change(download_change(service, change), change)
     upload_png(service, local_png_path, png_name)
 
-def main():
-    create_cache_dir()
-    credentials = get_credentials()
+def build_service(credentials):
+    import httplib2
+    from apiclient import discovery
     http = credentials.authorize(httplib2.Http())
-    service = discovery.build('drive', 'v3', http=http)
+    return discovery.build('drive', 'v3', http=http)
 
-    curr_token = get_start_page_token(service)
+class PngCache(object):
+    """
+    The cache of ChangePipeline, rendered pngs kept by the md5 of the raw
+    data. Drive lists the md5Checksum with a change, so a cached recording
+    isn't even downloaded, local files are hashed once they are read.
+    """
+    def __init__(self, folder=PNG_CACHE_FOLDER):
+        self.folder = folder
+
+    def path(self, md5):
+        return os.path.join(self.folder, md5 + '.png')
+
+    def lookup(self, change, raw=None):
+        """ Return the cached (local png path, png name) of a change, or None """
+        if raw is None:
+            md5 = change.get('file').get('md5Checksum')
+        else:
+            md5 = hashlib.md5(raw).hexdigest()
+        if md5 and os.path.exists(self.path(md5)):
+            print('Rendered before: ', change.get('file').get('name'), md5)
+            return self.path(md5), png_name_of(change)
+        return None
+
+    def store(self, raw, png):
+        dst = png_path_of(raw, self.folder)
+        # render_change() already renders into the default folder
+        if os.path.abspath(png[0]) != os.path.abspath(dst):
+            write_png(dst, lambda path: shutil.copyfile(png[0], path))
+
+class DriveCheckpoint(object):
+    """
+    The checkpoint of DriveSource, the Checkpoint of the page token and a
+    ProcessedRecord of the md5Checksum of every processed file id, so a
+    file listed again with the same content, e.g. renamed, moved or after
+    a restart, is skipped.
+
+    A change that failed isn't recorded, it is kept in `retry` for the next
+    polls instead, at most FAILED_POLL_RETRIES times.
+    """
+    def __init__(self, save_token=save_start_page_token, record_file=DRIVE_PROCESSED_FILE):
+        self.tokens = Checkpoint(save_token)
+        self.record = ProcessedRecord(record_file)
+        self.lock = threading.Lock()
+        # seq of the tokens -> (seq of the record, change)
+        self.record_seqs = {}
+        # the failed changes to submit again
+        self.retry = []
+        # file id -> the polls its failed changes were submitted again on
+        self.retries = {}
+
+    def add(self, change=None):
+        seq = self.tokens.add(change)
+        f = change.get('file')
+        record_seq = self.record.add({'file': {'id': f.get('id'), 'stamp': f.get('md5Checksum')}})
+        with self.lock:
+            self.record_seqs[seq] = (record_seq, change)
+        return seq
+
+    def add_token(self, token):
+        self.tokens.add_token(token)
+
+    def done(self, seq):
+        with self.lock:
+            record_seq, change = self.record_seqs.pop(seq)
+            self.retries.pop(change.get('file').get('id'), None)
+        self.record.done(record_seq)
+        self.tokens.done(seq)
+
+    def failed(self, seq):
+        with self.lock:
+            record_seq, change = self.record_seqs.pop(seq)
+            file_id = change.get('file').get('id')
+            if self.retries.get(file_id, 0) < FAILED_POLL_RETRIES:
+                self.retry.append(change)
+            else:
+                self.retries.pop(file_id)
+        self.record.failed(record_seq)
+        self.tokens.failed(seq)
+
+    def take_retry(self):
+        """ Return the failed changes to submit again """
+        with self.lock:
+            changes, self.retry = self.retry, []
+            for c in changes:
+                file_id = c.get('file').get('id')
+                self.retries[file_id] = self.retries.get(file_id, 0) + 1
+            return changes
+
+    def seen(self, change):
+        f = change.get('file')
+        # files without content, e.g. Google Docs, have no md5Checksum
+        return bool(f.get('md5Checksum')) and self.record.seen(f.get('id'), f.get('md5Checksum'))
+
+class DriveSource(object):
+    """
+    A monitor source that polls the changes of MONITOR_FOLDER_ID.
+
+    The saved token only advances when every change before it is done,
+    so changes in flight are listed again after a restart. Changes of
+    content that was processed before are skipped, failed changes are
+    tried again on the next polls.
+    """
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.service = build_service(credentials)
+        self.token = get_start_page_token(self.service)
+        self.checkpoint = DriveCheckpoint()
+
+    def make_service(self):
+        return build_service(self.credentials)
+
+    def download(self, service, change):
+        return download_change(service, change)
+
+    def upload(self, service, local_png_path, png_name):
+        upload_png(service, local_png_path, png_name)
+
+    def poll(self):
+        print('current token: ', self.token)
+        for c in self.checkpoint.take_retry():
+            if not self.checkpoint.seen(c):
+                yield c
 
-    while True:
-        print('current token: ', curr_token)
         new_token = None
-        for trashed, c, new_token in filter_changes(service, curr_token):
+        for trashed, c, new_token in filter_changes(self.service, self.token):
             # process changes
-            if not trashed and c:
-                process(service, c)
+            if not trashed and c and not self.checkpoint.seen(c):
+                yield c
 
         print('new token: ', new_token)
         if new_token:
-             save_start_page_token(new_token)
-             curr_token = new_token
+            self.checkpoint.add_token(new_token)
+            self.token = new_token
 
-        # print('sleep!')
-	time.sleep(POLLING_CHANGES_SECOND)
-        # print('wakeup!')
+    def wait(self):
+        time.sleep(POLLING_CHANGES_SECOND)
+
+def main():
+    global flags
+    flags = parse_flags()
+    create_cache_dir()
+
+    # a source provides poll(), wait(), make_service(), download(), upload()
+    # and the checkpoint of the pipeline
+    if flags and flags.watch_dir:
+        if not os.path.exists(flags.output_dir):
+            os.makedirs(flags.output_dir)
+        source = LocalSource(flags.watch_dir, flags.output_dir)
+    else:
+        source = DriveSource(get_credentials())
+
+    pipeline = ChangePipeline(source.make_service, source.download, render_change,
+                              source.upload, source.checkpoint,
+                              net_workers=flags.net_workers if flags else NET_WORKERS,
+                              cpu_workers=flags.cpu_workers if flags else CPU_WORKERS,
+                              cache=PngCache())
+    pipeline.start()
+
+    while True:
+        for c in source.poll():
+            print(c)
+            pipeline.submit(c)
+        source.wait()
 
     #results = service.files().list(
     #    pageSize=10,fields="nextPageToken, files(id, name)").execute()
@@ -0,0 +1,198 @@
+import numpy as np
+from scipy import signal
+from scipy.ndimage import maximum_filter1d
+
+from filters import FilterChain, design_sos, concat, ECG_FS
+
+# Pan-Tompkins style QRS detection
+QRS_LOW_CUTOFF = 5.0
+QRS_HIGH_CUTOFF = 15.0
+QRS_FILTER_ORDER = 2
+# the moving window integration of the squared slope
+INTEGRATION_SEC = 0.15
+# a peak must reach this share of the QRS energy level around it, the level
+# is the median of the maxima of LEVEL_WINDOWS one second windows
+THRESHOLD_RATIO = 0.3
+LEVEL_WINDOW_SEC = 1.0
+LEVEL_WINDOWS = 5
+# no beat can follow another one sooner
+REFRACTORY_SEC = 0.2
+# context kept between chunks, enough for every window above
+CONTEXT_SEC = 4.0
+
+# RR intervals out of 30 - 220 bpm are gaps or detection errors
+RR_MIN_MS = 60000.0 / 220
+RR_MAX_MS = 60000.0 / 30
+NN50_MS = 50
+
+def qrs_sos(fs):
+    """ The band pass of the QRS energy """
+    return np.vstack((design_sos("highpass", QRS_FILTER_ORDER, QRS_LOW_CUTOFF, fs),
+                      design_sos("lowpass", QRS_FILTER_ORDER, QRS_HIGH_CUTOFF, fs)))
+
+def integrate(bandpassed, fs):
+    """ The moving average of the squared slope over INTEGRATION_SEC """
+    slope = np.concatenate(([0.], np.diff(bandpassed)))
+    csum = np.cumsum(np.square(slope))
+    w = max(int(INTEGRATION_SEC * fs), 1)
+    mwi = np.empty_like(csum)
+    mwi[:w] = csum[:w] / w
+    mwi[w:] = (csum[w:] - csum[:-w]) / w
+    return mwi
+
+def qrs_level(mwi, at, fs):
+    """
+    The typical QRS energy around the samples `at`. A median of the maxima
+    of nearby windows, so a single artifact doesn't hide the beats next to it.
+    """
+    w = max(int(LEVEL_WINDOW_SEC * fs), 1)
+    maxima = maximum_filter1d(mwi, w)
+    half = LEVEL_WINDOWS // 2
+    idx = np.clip(at[:,np.newaxis] + np.arange(-half, half + 1) * w, 0, len(mwi) - 1)
+    return np.median(maxima[idx], axis=1)
+
+def find_qrs(values, bandpassed, fs):
+    """
+    values:     The filtered ecg (mv)
+    bandpassed: The values passed through qrs_sos()
+    return:     The indices of the R peaks in values
+
+    Peaks of the integrated energy above THRESHOLD_RATIO of qrs_level()
+    are QRS complexes. The R peak is the largest value in the
+    integration window before the energy peak.
+    """
+    if len(values) < 2:
+        return np.empty(0, dtype=np.int64)
+    mwi = integrate(bandpassed, fs)
+    refractory = max(int(REFRACTORY_SEC * fs), 1)
+    peaks, _ = signal.find_peaks(mwi, distance=refractory)
+    peaks = peaks[mwi[peaks] >= THRESHOLD_RATIO * qrs_level(mwi, peaks, fs)]
+    if len(peaks) == 0:
+        return peaks.astype(np.int64)
+
+    # the integration delays the energy peak behind the R peak
+    w = max(int(INTEGRATION_SEC * fs), 1)
+    idx = peaks[:,np.newaxis] - np.arange(w)[::-1]
+    idx = np.clip(idx, 0, len(values) - 1)
+    r = idx[np.arange(len(peaks)), np.argmax(values[idx], axis=1)]
+
+    # two energy peaks of one wide complex may refine to the same beat
+    keep = np.concatenate(([True], np.diff(r) >= refractory))
+    return r[keep].astype(np.int64)
+
+class RPeakDetector(object):
+    """
+    Detect R peaks in chunks of filtered ecg [timestamp, mv] rows, e.g.
+    the output of filters.ecg_filter_chain().
+
+    The band pass carries its state between chunks. The last CONTEXT_SEC of
+    a chunk is kept and detected together with the next chunk, so every
+    beat is found once, with all the context it needs, in linear time.
+    Call flush() at the end for the beats of the last CONTEXT_SEC.
+    """
+    def __init__(self, fs=ECG_FS):
+        self.fs = fs
+        self.context = int(CONTEXT_SEC * fs)
+        self.refractory_ms = REFRACTORY_SEC * 1000
+        self.reset()
+
+    def reset(self):
+        self.chain = FilterChain([qrs_sos(self.fs)])
+        # [timestamp, mv, bandpassed] rows not yet searched
+        self.pending = None
+        # rows of the pending rows that were already searched
+        self.searched = 0
+        self.last_peak_ms = None
+
+    def __call__(self, x):
+        return self.process(x)
+
+    def process(self, x):
+        """ Return the [timestamp, mv] rows of the R peaks found so far """
+        x = np.asarray(x)
+        if len(x) == 0:
+            return np.empty((0, 2))
+        bandpassed = self.chain(x[:,1])
+        self.pending = concat(self.pending, np.column_stack((x[:,0], x[:,1], bandpassed)))
+        return self._search(len(self.pending) - self.context)
+
+    def flush(self):
+        """ Return the R peaks of what is left, then reset """
+        peaks = np.empty((0, 2))
+        if self.pending is not None:
+            peaks = self._search(len(self.pending))
+        self.reset()
+        return peaks
+
+    def _search(self, end):
+        if end <= self.searched:
+            return np.empty((0, 2))
+        p = self.pending
+        r = find_qrs(p[:,1], p[:,2], self.fs)
+        r = r[(r >= self.searched) & (r < end)]
+        peaks = p[r][:,:2]
+        if self.last_peak_ms is not None:
+            peaks = peaks[peaks[:,0] >= self.last_peak_ms + self.refractory_ms]
+        if len(peaks):
+            self.last_peak_ms = peaks[-1,0]
+
+        # keep the context of what is not searched yet
+        start = max(end - self.context, 0)
+        self.pending = p[start:]
+        self.searched = end - start
+        return peaks
+
+def detect_r_peaks(data, fs=ECG_FS):
+    """
+    data:   Filtered ecg [timestamp, mv] rows, e.g. from filters.ecg_filter()
+    return: The [timestamp, mv] rows of the R peaks
+    """
+    d = RPeakDetector(fs)
+    peaks = d.process(data)
+    return np.concatenate((peaks, d.flush()))
+
+def rr_intervals(peaks):
+    """
+    peaks:  The R peaks from detect_r_peaks()
+    return: [timestamp, RR (ms)] rows at the second beat of every interval,
+            the intervals out of RR_MIN_MS - RR_MAX_MS are dropped
+    """
+    ts = np.asarray(peaks)[:,0] if len(peaks) else np.empty(0)
+    rr = np.diff(ts)
+    valid = (rr >= RR_MIN_MS) & (rr <= RR_MAX_MS)
+    return np.column_stack((ts[1:][valid], rr[valid]))
+
+def heart_rate(rr):
+    """ Return [timestamp, instantaneous heart rate (bpm)] rows of rr_intervals() """
+    rr = np.asarray(rr).reshape(-1, 2)
+    return np.column_stack((rr[:,0], 60000.0 / rr[:,1]))
+
+def hrv_metrics(rr):
+    """
+    rr:     The rows from rr_intervals()
+    return: The time-domain HRV metrics, in ms unless the name says otherwise
+    """
+    rr = np.asarray(rr).reshape(-1, 2)
+    intervals = rr[:,1]
+    if len(intervals) < 2:
+        return {"beats": len(intervals)}
+    hr = 60000.0 / intervals
+    # successive differences only between adjacent intervals, not across gaps
+    adjacent = np.abs(np.diff(rr[:,0]) - intervals[1:]) < 1e-6
+    sd = np.diff(intervals)[adjacent]
+    metrics = {"beats": len(intervals),
+               "mean_rr": float(np.mean(intervals)),
+               "sdnn": float(np.std(intervals, ddof=1)),
+               "mean_hr_bpm": float(np.mean(hr)),
+               "min_hr_bpm": float(np.min(hr)),
+               "max_hr_bpm": float(np.max(hr))}
+    if len(sd):
+        metrics["rmssd"] = float(np.sqrt(np.mean(np.square(sd))))
+        metrics["pnn50_percent"] = float(100.0 * np.mean(np.abs(sd) > NN50_MS))
+    return metrics
+
+def analyze_ecg(data, fs=ECG_FS):
+    """ Return (R peaks, RR intervals, HRV metrics) of filtered ecg rows """
+    peaks = detect_r_peaks(data, fs)
+    rr = rr_intervals(peaks)
+    return peaks, rr, hrv_metrics(rr)
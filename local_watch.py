@@ -0,0 +1,164 @@
+from __future__ import print_function
+import json
+import os
+import shutil
+import stat
+import threading
+import time
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+PROCESSED_FILE = 'processed_files.json'
+DEBOUNCE_SECOND = 1.0
+SCAN_SECOND = 1.0
+# times a file that failed is processed again before it is left alone
+# until it changes
+FAILED_RETRIES = 3
+# files that are still being written by sync tools, or our own outputs
+IGNORED_EXTS = ('.png', '.npz', '.tmp', '.part', '.crdownload')
+
+class ProcessedRecord(object):
+    """
+    The pipeline checkpoint of LocalSource.
+
+    Remember the [size, mtime] of every processed file in a json file, so a
+    file is processed again only when it changes, even after a restart.
+    A file that failed isn't recorded, it is tried again FAILED_RETRIES
+    times and then left alone until it changes or the monitor restarts.
+    """
+    def __init__(self, path=PROCESSED_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.next_seq = 0
+        self.in_flight = {}
+        self.processed = {}
+        # path -> (stamp, number of failures) of the last version that failed
+        self.failures = {}
+        if os.path.exists(path):
+            f = open(path, "r")
+            self.processed = json.load(f)
+            f.close()
+
+    def add(self, change=None):
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self.in_flight[seq] = change
+            return seq
+
+    def done(self, seq):
+        with self.lock:
+            f = self.in_flight.pop(seq).get('file')
+            self.processed[f.get('id')] = f.get('stamp')
+            self.failures.pop(f.get('id'), None)
+            self.save()
+
+    def failed(self, seq):
+        with self.lock:
+            f = self.in_flight.pop(seq).get('file')
+            stamp, count = self.failures.get(f.get('id'), (None, 0))
+            if stamp != f.get('stamp'):
+                count = 0
+            self.failures[f.get('id')] = (f.get('stamp'), count + 1)
+
+    def seen(self, path, stamp):
+        """ Whether this version of the file is processed or being processed """
+        with self.lock:
+            if self.processed.get(path) == stamp:
+                return True
+            failed_stamp, count = self.failures.get(path, (None, 0))
+            if failed_stamp == stamp and count > FAILED_RETRIES:
+                return True
+            for c in self.in_flight.values():
+                if c.get('file').get('id') == path and c.get('file').get('stamp') == stamp:
+                    return True
+            return False
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        f = open(tmp, "w")
+        json.dump(self.processed, f)
+        f.close()
+        os.rename(tmp, self.path)
+
+class LocalSource(object):
+    """
+    A monitor source that watches a local directory.
+
+    New or changed files are reported as changes in the format of the Drive
+    API, with the path as the file id. A file is reported once its writer
+    has closed it (with inotify), or once it has stopped changing for
+    `debounce` seconds. Without the optional inotify_simple package the
+    directory is scanned every SCAN_SECOND instead.
+    """
+    def __init__(self, watch_dir, output_dir, record_file=PROCESSED_FILE, debounce=DEBOUNCE_SECOND):
+        self.watch_dir = watch_dir
+        self.output_dir = output_dir
+        self.debounce = debounce
+        self.checkpoint = ProcessedRecord(record_file)
+        # path -> [size, mtime] of files not yet completely written
+        self.candidates = {}
+        # paths closed after writing, reported by inotify
+        self.closed = set()
+        self.inotify = None
+        if INotify is not None:
+            self.inotify = INotify()
+            self.inotify.add_watch(watch_dir, inotify_flags.CREATE | inotify_flags.MODIFY |
+                                   inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO)
+
+    def make_service(self):
+        return None
+
+    def download(self, service, change):
+        f = open(change.get('file').get('id'), 'rb')
+        raw = f.read()
+        f.close()
+        return raw
+
+    def upload(self, service, local_png_path, png_name):
+        dst = os.path.join(self.output_dir, png_name)
+        if os.path.abspath(dst) != os.path.abspath(local_png_path):
+            shutil.copyfile(local_png_path, dst)
+        print('Saved: ', dst)
+
+    def poll(self):
+        """ Return the changes of the files that are completely written """
+        now = time.time()
+        for name in sorted(os.listdir(self.watch_dir)):
+            path = os.path.join(self.watch_dir, name)
+            if name.startswith('.') or os.path.splitext(name)[1] in IGNORED_EXTS:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                # removed in the meantime
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+
+            stamp = [st.st_size, st.st_mtime]
+            if self.checkpoint.seen(path, stamp):
+                continue
+            last = self.candidates.get(path)
+            quiet = last == stamp and now - st.st_mtime >= self.debounce
+            if path not in self.closed and not quiet:
+                self.candidates[path] = stamp
+                continue
+
+            self.candidates.pop(path, None)
+            self.closed.discard(path)
+            yield {'file': {'id': path, 'name': name, 'stamp': stamp}}
+
+    def wait(self):
+        """ Block until a file may be ready """
+        if self.inotify is None:
+            time.sleep(SCAN_SECOND)
+            return
+        # wake up on the next event, or when the candidates have been quiet long enough
+        timeout = int(self.debounce * 1000) if self.candidates else None
+        for event in self.inotify.read(timeout=timeout):
+            if event.mask & (inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO):
+                self.closed.add(os.path.join(self.watch_dir, event.name))
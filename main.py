@@ -1,99 +1,276 @@
 
 import os
+import sys
 import argparse
-import rx
 import numpy as np
 import time
-import matplotlib.pyplot as plot
-from rx import Observable
-from parser import calc_ts
-from parser import parse_raw_acc, acc_data
-from parser import parse_raw_ecg, ecg_data
-from parser import parse_raw_ppg, ppg_data
-from filters import ppg512_hp_filter, ppg512_lp_filter, ppg512_pl_filter
-from filters import ecg_hp_filter, ecg_lp_filter, ecg_pl_filter
-from filters import acc_flat
-from filters import ACC_FS, ECG_FS, PPG_FS_512
-from plots import plot_time_domain, plot_freq_domain, plot_annotation
+import Queue
+from parser import parse_signals, iter_signals, concat_signals
+from parse_cache import load_signals
+from parser import TYPE_ACC, TYPE_ECG, TYPE_PPG125, TYPE_PPG512
+from filters import ppg512_filter, ecg_filter
+from filters import ecg_filter_chain, ppg512_filter_chain
+from filters import ACC_FS, ECG_FS, PPG_FS_125, PPG_FS_512, concat
+from spectral import SPECTRUM_KINDS
 from annotation import parse_annotation, annotation_data
+from export import export_signals, EXPORT_FORMATS, SIGNAL_NAMES
+from export import SignalExporter, write_filtered, flush_filters
+from follow import RawFollower, FOLLOW_INTERVAL_SEC
+from acc import acc_columns, magnitude_rows
+from profiling import StageProfiler, size_of
+
+# a pipeline per signal and one for the export
+PIPELINE_WORKERS = 4
+EXPORT_TYPES = (TYPE_ACC, TYPE_ECG, TYPE_PPG512)
+SIGNAL_FS = {TYPE_ACC: ACC_FS, TYPE_ECG: ECG_FS, TYPE_PPG125: PPG_FS_125, TYPE_PPG512: PPG_FS_512}
+# the seconds shown while following a growing file
+FOLLOW_WINDOW_SEC = 10
 
 def parse_args():
     p = argparse.ArgumentParser()
-    p.add_argument('--export_csv', help='Export to csv file', action='store_true')
+    p.add_argument('--export', choices=EXPORT_FORMATS, help='Export the signals to csv, npy or npz files')
+    p.add_argument('--export_csv', help='Same as --export csv', action='store_true')
+    p.add_argument('--no_cache', help='Always parse the raw data file', action='store_true')
+    p.add_argument('--spectrum', choices=SPECTRUM_KINDS, default='fft',
+                   help='How the lower plot shows the spectrum (default: fft)')
+    p.add_argument('--beats', help='Mark the R peaks of ecg and print the HRV metrics', action='store_true')
+    p.add_argument('--profile', nargs='?', const='', metavar='JSON_FILE',
+                   help='Time every pipeline stage, write the report to JSON_FILE (default: <raw file>_profile.json)')
+    p.add_argument('--export_only', help='Only export, headless, pyplot is never imported', action='store_true')
+    p.add_argument('--follow', nargs='?', type=float, const=FOLLOW_INTERVAL_SEC, metavar='SECONDS',
+                   help='Keep processing what is appended to the raw data file, checking every SECONDS '
+                        '(default: %g)' % FOLLOW_INTERVAL_SEC)
     p.add_argument('raw_data_file', nargs=1, help='Specify the raw data file')
     p.add_argument('annotation_file', nargs='?', help='Specify the annotation file')
     p.add_argument('type', nargs=1, help='5: ECG, 9: PPG 125 Hz, 12: PPG 512 Hz)')
-    return vars(p.parse_args())
+    opts = vars(p.parse_args())
+    if opts["export_only"] and not (opts["export"] or opts["export_csv"]):
+        p.error("--export_only needs --export or --export_csv")
+    return opts
 
 def validate_args():
     t = int(args["type"][0])
     if t != 0 and t != 5 and t != 9 and t != 12:
         raise Exception("Unknown type")
 
-def group_key_generator(x):
-    return x.split(',')[0]
+def signal_types():
+    """ Only the plotted type is needed, the export streams the file on its own """
+    return (int(args["type"][0]),)
+
+def load(signal_type):
+    """ Parse a signal type, or load it from the cache, ambient ppg data has been skipped by the watch """
+    # the stage name tells whether the time went to parsing or to the cache
+    with profiler.measure("parse" if args["no_cache"] else "load", SIGNAL_NAMES[signal_type]) as record:
+        if args["no_cache"]:
+            f = open(args["raw_data_file"][0])
+            data = parse_signals(f, (signal_type,), skip_ambient=False)[signal_type]
+            f.close()
+        else:
+            data = load_signals(args["raw_data_file"][0], (signal_type,), skip_ambient=False)[signal_type]
+        record["input"] = {"bytes": os.path.getsize(args["raw_data_file"][0])}
+        record["output"] = size_of(data)
+    return data
+
+def export(fmt):
+    """ Stream the signals from the raw data file to the export files, filtered as plotted """
+    f = open(args["raw_data_file"][0])
+    chunks = iter_signals(f, EXPORT_TYPES, skip_ambient=False)
+    with profiler.measure("export", "all"):
+        paths = export_signals(chunks, args["export_prefix"], EXPORT_TYPES, fmt, export_filters())
+    f.close()
+    return paths
+
+def export_filters():
+    """ The export is filtered as plotted, without the delay of a causal filter """
+    return {TYPE_ECG: ecg_filter_chain(zero_phase=True),
+            TYPE_PPG512: ppg512_filter_chain(zero_phase=True)}
+
+class Follow(object):
+    """
+    Process what is appended to the raw data file since the last update,
+    the export files stay open and are written as the file grows. When the
+    file is replaced the exports start over, and `replaced` tells the
+    caller of update() to drop its own state of the old file.
+    """
+    def __init__(self):
+        types = set(signal_types())
+        if args["export"]:
+            types.update(EXPORT_TYPES)
+        self.follower = RawFollower(args["raw_data_file"][0], tuple(sorted(types)), skip_ambient=False,
+                                    on_replaced=self.restart)
+        self.replaced = False
+        self.exporter = None
+        self.start_export()
+
+    def start_export(self):
+        if args["export"]:
+            self.exporter = SignalExporter(args["export_prefix"], EXPORT_TYPES, args["export"])
+            self.filters = export_filters()
+
+    def restart(self):
+        """ Called by the follower when the file was replaced """
+        self.replaced = True
+        if self.exporter is not None:
+            # the exports of the old file are overwritten by the new one
+            self.exporter.close()
+            self.start_export()
 
-def group_by_handler(x):
-    if x.key == '0':
-        x.subscribe(on_next=parse_raw_acc, on_completed=acc_data_handler)
-    elif x.key == '5':
-        x.subscribe(on_next=parse_raw_ecg, on_completed=ecg_data_handler)
-    elif x.key == '12':
-        x.subscribe(on_next=parse_raw_ppg, on_completed=ppg_data_handler)
+    def update(self):
+        """ Export the new chunks and return them """
+        self.replaced = False
+        chunks = self.follower.update()
+        if self.exporter is not None:
+            for chunk in chunks:
+                write_filtered(self.exporter, chunk, self.filters)
+        return chunks
+
+    def close(self):
+        if self.exporter is not None:
+            flush_filters(self.exporter, self.filters)
+            for path in self.exporter.close():
+                print "exported: " + path
+
+def follow_export():
+    """ Export as the raw data file grows, until interrupted """
+    session = Follow()
+    try:
+        while True:
+            if not session.update():
+                time.sleep(args["follow"])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        session.close()
+
+def follow_plot():
+    """ Plot the last FOLLOW_WINDOW_SEC of the plotted type as the raw data file grows """
+    t = signal_types()[0]
+    session = Follow()
+    # causal, so the newest samples are shown right away
+    new_chain = {TYPE_ECG: ecg_filter_chain, TYPE_PPG512: ppg512_filter_chain}.get(t)
+    chain = [new_chain() if new_chain else None]
+    window = [None]
+    line, = ax1.plot([], [], 'b')
+    ax1.set_xlabel("Epoch Time (ms)")
+    ax1.set_ylabel("MV")
+
+    def update():
+        new = [c[t] for c in session.update() if len(c[t])]
+        if session.replaced:
+            chain[0] = new_chain() if new_chain else None
+            window[0] = None
+        if not new:
+            return
+        data = concat_signals(new)
+        if t == TYPE_ACC:
+            data = magnitude_rows(*acc_columns(data))
+        elif chain[0] is not None:
+            data = chain[0](data)
+        w = concat(window[0], data)
+        w = w[w[:,0] >= w[-1,0] - FOLLOW_WINDOW_SEC * 1000]
+        window[0] = w
+        line.set_data(w[:,0], w[:,1])
+        ax1.relim()
+        ax1.autoscale_view()
+        ax2.cla()
+        plot_spectrum(ax2, w, SIGNAL_FS[t], args["spectrum"])
+        ax1.figure.canvas.draw_idle()
+
+    update()
+    timer = ax1.figure.canvas.new_timer(interval=int(args["follow"] * 1000))
+    timer.add_callback(update)
+    timer.start()
+    try:
+        plot.show()
+    finally:
+        session.close()
+
+def run_pipeline(observable, output):
+    """
+    Run the observable on the thread pool, every item it emits is handed
+    to output() on the main thread by render_pipelines()
+    """
+    running[0] += 1
+    observable.subscribe_on(pool).subscribe(
+        on_next=lambda x: main_thread.put((output, x)),
+        on_error=lambda e: main_thread.put((None, e)),
+        on_completed=lambda: main_thread.put((None, None)))
+
+def render_pipelines():
+    """ Run the outputs of the pipelines on the main thread until all have completed """
+    while running[0]:
+        output, x = main_thread.get()
+        if output is not None:
+            output(x)
+            continue
+        running[0] -= 1
+        if x is not None:
+            raise x
 
 def acc_data_handler():
     print "acc data handler!!!"
-    def output(x):
-        if args["export_csv"]:
-            np.savetxt(args["acc_csv"], x, delimiter=',')
-        if int(args["type"][0]) == 0:
-            s = np.square(x[:,1:])
-            mag = np.sum(s, axis=1)
-            mag = np.column_stack((x[:,0], mag))
-            plot_time_domain(ax1, mag)
-            plot_freq_domain(ax2, mag[:,1], ACC_FS)
+    def magnitude(x):
+        ts, xyz = acc_columns(x)
+        return magnitude_rows(ts, xyz)
+
+    def output(mag):
+        plot_time_domain(ax1, mag)
+        plot_spectrum(ax2, mag, ACC_FS, args["spectrum"])
 
     # pipeline
-    Observable.just(acc_data)             \
-              .map(calc_ts)               \
-              .map(acc_flat)              \
-              .map(lambda x: np.array(x)) \
-              .subscribe(output)
+    run_pipeline(Observable.just(TYPE_ACC)                      \
+                           .map(load)                           \
+                           .filter(lambda x: len(x) > 0)        \
+                           .map(profiler.wrap("magnitude", "acc", magnitude)),
+                 profiler.wrap("plot", "acc", output))
 
 def ecg_data_handler():
     print "ecg data handler!!!"
+    def beats(x):
+        # the detection runs on the pool too, only its plot is left to the main thread
+        if args["beats"]:
+            from hrv import analyze_ecg
+            return x, profiler.wrap("beats", "ecg", analyze_ecg)(x)
+        return x, None
+
     def output(x):
-        if args["export_csv"]:
-            np.savetxt(args["ecg_csv"], x, delimiter=',')
-        if int(args["type"][0]) == 5:
-            plot_time_domain(ax1, x)
-            plot_freq_domain(ax2, x[:,1], ECG_FS)
+        x, analysis = x
+        plot_time_domain(ax1, x)
+        plot_spectrum(ax2, x, ECG_FS, args["spectrum"])
+        if analysis:
+            peaks, _, metrics = analysis
+            plot_r_peaks(ax1, peaks)
+            print metrics
 
     # pipeline
-    Observable.just(ecg_data)             \
-              .map(calc_ts)               \
-              .map(lambda x: np.array(x)) \
-              .map(ecg_pl_filter) \
-              .map(ecg_hp_filter) \
-              .map(ecg_lp_filter) \
-              .subscribe(output)
+    run_pipeline(Observable.just(TYPE_ECG)                      \
+                           .map(load)                           \
+                           .filter(lambda x: len(x) > 0)        \
+                           .map(profiler.wrap("filter", "ecg", ecg_filter)) \
+                           .map(beats),
+                 profiler.wrap("plot", "ecg", output))
 
 def ppg_data_handler():
     print "ppg data handler!!!"
     def output(x):
-        if args["export_csv"]:
-            np.savetxt(args["ppg_csv"], x, delimiter=',')
-        if int(args["type"][0]) == 12:
-            plot_time_domain(ax1, x)
-            plot_freq_domain(ax2, x[:,1], PPG_FS_512)
+        plot_time_domain(ax1, x)
+        plot_spectrum(ax2, x, PPG_FS_512, args["spectrum"])
 
     # pipeline
-    Observable.just(ppg_data)             \
-              .map(calc_ts)               \
-              .map(lambda x: np.array(x)) \
-              .map(ppg512_hp_filter) \
-              .map(ppg512_lp_filter) \
-              .subscribe(output)
+    run_pipeline(Observable.just(TYPE_PPG512)                   \
+                           .map(load)                           \
+                           .filter(lambda x: len(x) > 0)        \
+                           .map(profiler.wrap("filter", "ppg", ppg512_filter)),
+                 profiler.wrap("plot", "ppg", output))
+
+def export_handler():
+    print "export handler!!!"
+    def output(paths):
+        for path in paths:
+            print "exported: " + path
+
+    # pipeline
+    run_pipeline(Observable.just(args["export"]).map(export), output)
 
 def annotation_handler():
     print "annotation handler !!!"
@@ -102,9 +279,11 @@ def annotation_handler():
 def verbose(x):
     print x
 
-######################################################################
+def save_profile():
+    profiler.save(args["profile"], raw_data_file=args["raw_data_file"][0])
+    print "profile: " + args["profile"]
 
-_, (ax1, ax2) = plot.subplots(2, 1)
+######################################################################
 
 # parse arguments
 args = parse_args()
@@ -115,15 +294,45 @@ validate_args()
 
 # prepare something for later use
 basename = os.path.basename(args["raw_data_file"][0])
-args["acc_csv"] = os.path.splitext(basename)[0] + "_acc.csv"
-args["ecg_csv"] = os.path.splitext(basename)[0] + "_ecg.csv"
-args["ppg_csv"] = os.path.splitext(basename)[0] + "_ppg.csv"
+args["export_prefix"] = os.path.splitext(basename)[0]
+if args["export_csv"] and not args["export"]:
+    args["export"] = "csv"
+if args["profile"] == "":
+    args["profile"] = args["export_prefix"] + "_profile.json"
+profiler = StageProfiler(enabled=args["profile"] is not None)
+
+if args["export_only"] and args["follow"]:
+    follow_export()
+    sys.exit(0)
+
+if args["export_only"]:
+    # headless, neither pyplot nor rx nor the plots are imported
+    for path in export(args["export"]):
+        print "exported: " + path
+    if args["profile"]:
+        save_profile()
+    sys.exit(0)
 
-# Ideally, observables can be executed in different threads.
-# However, it's difficult becuase matplotlib can only be executed in
-# the main thread and pyplot.show() only can be executed once.
-# So, we only take advantage of reactivex to build the data pipeline by
-# observable::map().
+# the plotting modules are only imported when something is plotted
+import matplotlib.pyplot as plot
+from rx import Observable
+from rx.concurrency import ThreadPoolScheduler
+from plots import plot_time_domain, plot_spectrum, plot_annotation, plot_r_peaks
+
+_, (ax1, ax2) = plot.subplots(2, 1)
+
+if args["follow"]:
+    follow_plot()
+    sys.exit(0)
+
+# The pipelines of the signals and the export run concurrently on a thread
+# pool, numpy and scipy release the GIL while they filter. matplotlib can
+# only be used on the main thread and pyplot.show() only once, so what the
+# pipelines emit is plotted on the main thread by render_pipelines().
+pool = ThreadPoolScheduler(PIPELINE_WORKERS)
+main_thread = Queue.Queue()
+# the number of pipelines not completed yet
+running = [0]
 
 if args["annotation_file"]:
     a = open(args["annotation_file"])
@@ -132,10 +341,20 @@ if args["annotation_file"]:
               .filter(lambda x: True if x else False)   \
               .subscribe(on_next=parse_annotation, on_completed=annotation_handler)
 
-f = open(args["raw_data_file"][0])
-lines = f.read().split('\n')
-Observable.from_(lines)                  \
-          .group_by(group_key_generator) \
-          .subscribe(group_by_handler)
+handlers = {TYPE_ACC: acc_data_handler, TYPE_ECG: ecg_data_handler, TYPE_PPG512: ppg_data_handler}
+for t in signal_types():
+    if t in handlers:
+        handlers[t]()
+
+if args["export"]:
+    export_handler()
+
+render_pipelines()
+
+if args["profile"]:
+    # draw once here, so the rendering is timed apart from the interactive window
+    with profiler.measure("render", SIGNAL_NAMES[signal_types()[0]]):
+        plot.gcf().canvas.draw()
+    save_profile()
 
 plot.show()
@@ -0,0 +1,239 @@
+import errno
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+
+from parser import parse_signals, is_ppg, ALL_TYPES, PARSER_VERSION
+
+PARSE_CACHE_FOLDER = os.path.join(os.path.expanduser('~'), '.cache', 'bio_data_parser')
+PARSE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+DIGEST_FOLDER = 'digests'
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+# files still being written, an entry holding one is never evicted
+TMP_PREFIX = '.tmp'
+# entries used or written this recently are never evicted, other processes
+# sharing the cache, e.g. batch workers, may be about to write to them
+EVICT_MIN_AGE_SECOND = 60
+
+def signal_file(entry_dir, signal_type, skip_ambient=True):
+    if is_ppg(signal_type) and not skip_ambient:
+        return os.path.join(entry_dir, "%d_all.npy" % signal_type)
+    return os.path.join(entry_dir, "%d.npy" % signal_type)
+
+def make_key(digest, size, mtime):
+    """ The cache key changes with the content and the parser version """
+    return "%s-%d-%d-v%d" % (digest, size, int(mtime), PARSER_VERSION)
+
+def hash_file(path):
+    h = hashlib.sha1()
+    f = open(path, 'rb')
+    while True:
+        block = f.read(HASH_BLOCK_SIZE)
+        if not block:
+            break
+        h.update(block)
+    f.close()
+    return h.hexdigest()
+
+def mtime_stamp(st):
+    """ The mtime at full precision, so a rewrite within a second is noticed """
+    if hasattr(st, 'st_mtime_ns'):
+        return "%d" % st.st_mtime_ns
+    return repr(st.st_mtime)
+
+def file_key(path, cache_dir=PARSE_CACHE_FOLDER):
+    """
+    Return the cache key of a raw data file.
+
+    Hashing a large file takes a while, so the digest is remembered per
+    (path, size, mtime) and only recomputed when the file changes.
+    """
+    st = os.stat(path)
+    path_id = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    memo_dir = os.path.join(cache_dir, DIGEST_FOLDER)
+    memo_path = os.path.join(memo_dir, path_id)
+    stamp = "%d %s" % (st.st_size, mtime_stamp(st))
+
+    if os.path.exists(memo_path):
+        f = open(memo_path, "r")
+        saved_stamp, _, digest = f.readline().rstrip("\n").rpartition(' ')
+        f.close()
+        if saved_stamp == stamp:
+            return make_key(digest, st.st_size, st.st_mtime)
+
+    digest = hash_file(path)
+    if not os.path.exists(memo_dir):
+        os.makedirs(memo_dir)
+    f = open(memo_path, "w")
+    f.write("%s %s\n" % (stamp, digest))
+    f.close()
+    return make_key(digest, st.st_size, st.st_mtime)
+
+def lookup(key, signal_types, cache_dir=PARSE_CACHE_FOLDER, skip_ambient=True):
+    """ Return {signal_type: memory-mapped numpy array} of the cached types """
+    entry_dir = os.path.join(cache_dir, key)
+    signals = {}
+    if not os.path.isdir(entry_dir):
+        return signals
+    for t in signal_types:
+        path = signal_file(entry_dir, t, skip_ambient)
+        if os.path.exists(path):
+            signals[t] = np.load(path, mmap_mode='r')
+    if signals:
+        touch(entry_dir)
+    return signals
+
+def touch(entry_dir):
+    """ Mark an entry as recently used for the LRU eviction """
+    try:
+        os.utime(entry_dir, None)
+    except OSError:
+        # evicted by another process in the meantime
+        pass
+
+def make_entry_dir(entry_dir):
+    try:
+        os.makedirs(entry_dir)
+    except OSError as e:
+        # created by another process in the meantime
+        if e.errno != errno.EEXIST:
+            raise
+
+def save_file(entry_dir, path, save):
+    """
+    Call save(file obj) on a temporary file in the entry, then move it to
+    path, so readers never see partial data
+    """
+    fd, tmp = tempfile.mkstemp(prefix=TMP_PREFIX, dir=entry_dir)
+    f = os.fdopen(fd, 'wb')
+    try:
+        save(f)
+        f.close()
+        os.rename(tmp, path)
+    except Exception:
+        f.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def store(key, signals, cache_dir=PARSE_CACHE_FOLDER, skip_ambient=True):
+    """ Save {signal_type: numpy array} as one .npy file per type """
+    entry_dir = os.path.join(cache_dir, key)
+    make_entry_dir(entry_dir)
+    for t, data in signals.items():
+        save_file(entry_dir, signal_file(entry_dir, t, skip_ambient), lambda f: np.save(f, data))
+    touch(entry_dir)
+
+def load_derived(path, name, build, cache_dir=PARSE_CACHE_FOLDER, max_bytes=PARSE_CACHE_MAX_BYTES):
+    """
+    path:   The raw data file
+    name:   What is derived, it must change whenever build() does
+    build:  A function returning {name: numpy array}
+    return: {name: numpy array}, build() is only called when they are not
+            cached yet
+
+    Arrays derived from the signals of a raw data file, e.g. the pyramid
+    of a filtered signal, are kept in the cache entry of the file as
+    <name>.npz and evicted together with it.
+    """
+    entry_dir = os.path.join(cache_dir, file_key(path, cache_dir))
+    derived_path = os.path.join(entry_dir, name + '.npz')
+    if os.path.exists(derived_path):
+        z = np.load(derived_path)
+        arrays = dict((k, z[k]) for k in z.files)
+        z.close()
+        touch(entry_dir)
+        return arrays
+
+    arrays = build()
+    make_entry_dir(entry_dir)
+    save_file(entry_dir, derived_path, lambda f: np.savez(f, **arrays))
+    touch(entry_dir)
+    evict(cache_dir, max_bytes)
+    return arrays
+
+def entry_info(path):
+    """
+    Return (mtime, size, whether a file is still being written) of an
+    entry, or None when it is gone
+    """
+    try:
+        mtime = os.path.getmtime(path)
+        size = 0
+        writing = False
+        for root, _, files in os.walk(path):
+            for name in files:
+                writing = writing or name.startswith(TMP_PREFIX)
+                size += os.path.getsize(os.path.join(root, name))
+    except OSError:
+        # evicted by another process in the meantime
+        return None
+    return mtime, size, writing
+
+def evict(cache_dir=PARSE_CACHE_FOLDER, max_bytes=PARSE_CACHE_MAX_BYTES):
+    """
+    Remove the least recently used entries until the cache fits max_bytes.
+    Entries being written or used within EVICT_MIN_AGE_SECOND are kept,
+    another process may still be writing to them.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name == DIGEST_FOLDER or not os.path.isdir(path):
+            continue
+        info = entry_info(path)
+        if info is not None:
+            entries.append(info + (path,))
+
+    total = sum(e[1] for e in entries)
+    now = time.time()
+    for mtime, size, writing, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if writing or now - mtime < EVICT_MIN_AGE_SECOND:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+def load_cached(key, read, signal_types, cache_dir, max_bytes, skip_ambient):
+    signals = lookup(key, signal_types, cache_dir, skip_ambient)
+    missing = [t for t in signal_types if t not in signals]
+    if missing:
+        f = read()
+        try:
+            parsed = parse_signals(f, missing, skip_ambient=skip_ambient)
+        finally:
+            f.close()
+        store(key, parsed, cache_dir, skip_ambient)
+        evict(cache_dir, max_bytes)
+        signals.update(parsed)
+    return signals
+
+def load_signals(path, signal_types=ALL_TYPES, cache_dir=PARSE_CACHE_FOLDER,
+                 max_bytes=PARSE_CACHE_MAX_BYTES, skip_ambient=True):
+    """
+    path:         The raw data file
+    signal_types: The signal types to keep, e.g. (TYPE_ECG, TYPE_PPG512)
+    skip_ambient: See parser.decode_signal()
+    return:       {signal_type: numpy array} as parse_signals() returns
+
+    Only the types missing from the cache are parsed. Cached arrays are
+    memory-mapped read-only, copy them before modifying in place.
+    """
+    key = file_key(path, cache_dir)
+    return load_cached(key, lambda: open(path), signal_types, cache_dir, max_bytes, skip_ambient)
+
+def load_signals_from_file_obj(file_obj, signal_types=ALL_TYPES, cache_dir=PARSE_CACHE_FOLDER,
+                               max_bytes=PARSE_CACHE_MAX_BYTES, skip_ambient=True):
+    """ Same as load_signals() but for the file obj come from io.BytesIO """
+    raw = file_obj.read()
+    if not isinstance(raw, bytes):
+        raw = raw.encode('ascii')
+    key = make_key(hashlib.sha1(raw).hexdigest(), len(raw), 0)
+    return load_cached(key, lambda: io.BytesIO(raw), signal_types, cache_dir, max_bytes, skip_ambient)
@@ -1,14 +1,35 @@
+import mmap
+import os
 import numpy as np
-import re
 
+TYPE_ACC=0
 TYPE_ECG=5
 TYPE_PPG125=9
 TYPE_PPG512=12
 MSEC_PER_SEC = 1000
+ALL_TYPES = (TYPE_ACC, TYPE_ECG, TYPE_PPG125, TYPE_PPG512)
+# bump when the decoded output changes to invalidate parse_cache entries
+PARSER_VERSION = 2
 
-acc_data = []
-ppg_data = []
-ecg_data = []
+# raw data layout
+NUM_COLUMNS = 16
+TS_COLUMN = 15
+ACC_COLUMNS = [2, 3, 4, 6, 7, 8, 10, 11, 12]
+ACC_MIN = np.iinfo(np.int16).min
+ACC_MAX = np.iinfo(np.int16).max
+
+# bytes read at a time, this bounds the memory used for raw text, and a
+# block and the arrays decoded from it stay in the CPU cache
+BLOCK_SIZE = 512 * 1024
+
+# the bytes the rows are selected by
+NEWLINE = ord('\n')
+COMMA = ord(',')
+ZERO = ord('0')
+
+# sign fix-up of the raw samples
+SIGN_THRESHOLD = 4194304
+SIGN_OFFSET = 8388608
 
 def convert_ppg_to_mv(v):
     if v >= 4194304:
@@ -26,107 +47,354 @@ def is_ecg(t):
     else:
         return False
 
-def parse_raw_acc(x):
-    """ Parse one line of raw acc data and add it to acc data """
-    items = x.split(',')
-    nums = map(int, items)
-    ts_ms = nums[15] * MSEC_PER_SEC
-    acc_data.append((ts_ms, (nums[2], nums[3], nums[4])))
-    acc_data.append((ts_ms, (nums[6], nums[7], nums[8])))
-    acc_data.append((ts_ms, (nums[10], nums[11], nums[12])))
-
-def parse_raw_ppg(x):
-    """ Parse one line of raw ppg data and add it to ppg data """
-    items = x.split(',')
-    # convert ppg to mv
-    strs = items[2:13]
-    nums = map(int, strs)
-    nums = map(convert_ppg_to_mv, nums)
-    # convert ts to ms
-    ts_ms = int(items[15]) * MSEC_PER_SEC
-    for n in nums:
-        ppg_data.append((ts_ms, n))
-
-def parse_raw_ecg(x):
-    """ Parse one line of raw ecg data and add it to ecg data """
-    items = x.split(',')
-    # convert ppg to mv
-    strs = items[2:13]
-    nums = map(int, strs)
-    nums = map(convert_ecg_to_mv, nums)
-    # convert ts to ms
-    ts_ms = int(items[15]) * MSEC_PER_SEC
-    for n in nums:
-        ecg_data.append((ts_ms, n))
+def is_acc(t):
+    if t == TYPE_ACC:
+        return True
+    else:
+        return False
+
+def is_ppg125(t):
+    if t == TYPE_PPG125:
+        return True
+    else:
+        return False
+
+def is_ppg512(t):
+    if t == TYPE_PPG512:
+        return True
+    else:
+        return False
+
+def is_ppg(t):
+    if is_ppg125(t) or is_ppg512(t):
+        return True
+    else:
+        return False
+
+def sign_fixed(a):
+    """ The int array of the samples with the sign fix-up applied """
+    a = np.asarray(a)
+    return a - SIGN_OFFSET * (a >= SIGN_THRESHOLD)
+
+def convert_ppg_array_to_mv(a):
+    """ The numpy array version of convert_ppg_to_mv """
+    v = sign_fixed(a)
+    return (v * 3.2 * 1000) / 65536
+
+def convert_ecg_array_to_mv(a):
+    """ The numpy array version of convert_ecg_to_mv """
+    # v * 1000 is exact in int64, so this gives the same floats as
+    # dividing float samples
+    v = sign_fixed(a)
+    return np.true_divide(v * 1000, 6 * 2097152)
+
+def interpolate_ts(base_ms, per_row=1):
+    """
+    base_ms: numpy array of the per-second timestamp (ms) of every sample,
+             or of every row of per_row samples
+    per_row: The number of samples that share an entry of base_ms
+    return:  numpy array of the interpolated timestamp of every sample
+
+    The samples of one second are spread evenly until the next per-second
+    timestamp. The samples of the last second have no next timestamp, so
+    they are dropped and the returned array can be shorter than the input.
+    """
+    base_ms = np.asarray(base_ms)
+    # index of the first sample of every second except the first one
+    starts = (np.flatnonzero(base_ms[1:] != base_ms[:-1]) + 1) * per_row
+    if len(starts) == 0:
+        return np.empty(0, dtype=np.float64)
+
+    run_starts = np.concatenate(([0], starts[:-1]))
+    run_lens = starts - run_starts
+    base = base_ms[run_starts // per_row]
+    new_base = base_ms[starts // per_row]
+    fraction = (new_base - base).astype(np.float64) / run_lens
+
+    # the run of every row, the samples of a row share it
+    row_run = np.repeat(np.arange(len(run_lens)), run_lens // per_row)
+    i = (np.arange(len(row_run)) * per_row - run_starts[row_run])[:, None] + np.arange(per_row)
+    ts_ms = (base[row_run][:, None] + (fraction[row_run][:, None] * i)).ravel()
+    # sanity check, the timestamps of a run are monotonic so its first
+    # and last ones are the only candidates
+    last = base + (fraction * (run_lens - 1))
+    if np.any((base >= new_base) | (last >= new_base)):
+        print("Error: timestamp equal to or larger than new base timestamp")
+    return ts_ms
 
 def calc_ts(x):
-    base_ms = 0
-    data = []
-    buf = []
-    for l in x:
-        new_ms = l[0]
-        mv = l[1]
-        if base_ms == 0:
-            base_ms = new_ms
-        elif base_ms != new_ms:
-            fraction = float(new_ms - base_ms) / len(buf)
-            for i in range(0, len(buf)):
-                ts_ms = base_ms + (fraction * i)
-                if ts_ms >= new_ms:
-                    print "Error: timestamp equal to or larger than new base timestamp"
-                data.append((ts_ms, buf[i]))
-            base_ms = new_ms
-            buf[:] = []
-        buf.append(mv)
-    return data
+    """ A map function to interpolate the timestamp of every sample
+    Input: list, e.g. [(timestamp, value)]
+    Output: list, e.g. [(interpolated timestamp, value)]
+    """
+    ts_ms = interpolate_ts([l[0] for l in x])
+    return list(zip(ts_ms.tolist(), [l[1] for l in x]))
 
-def parse_data(file_obj, signal_type):
+def to_text(s):
+    """ Data read from io.BytesIO or mmap may be bytes """
+    if not isinstance(s, str):
+        s = s.decode('ascii')
+    return s
+
+def iter_blocks(file_obj, block_size=BLOCK_SIZE, use_mmap=False):
     """
-    file_obj:    The file obj come from open() or io.BytesIO
-    signal_type: 5, 9, or 12
-    return:      The list of (timestamp, mv) tuple
+    file_obj:   The file obj come from open() or io.BytesIO
+    block_size: The number of bytes read at a time
+    use_mmap:   Read through mmap, file_obj must be a real file
+    return:     A generator of str blocks which only contain whole lines
+
+    A line that spans two reads is carried over to the next block.
+    """
+    buf = None
+    if use_mmap:
+        if os.fstat(file_obj.fileno()).st_size == 0:
+            return
+        buf = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        read = buf.read
+    else:
+        read = file_obj.read
+
+    try:
+        rest = ''
+        while True:
+            block = to_text(read(block_size))
+            if not block:
+                break
+            block = rest + block
+            end = block.rfind('\n') + 1
+            rest = block[end:]
+            if end:
+                yield block[:end]
+        if rest:
+            yield rest
+    finally:
+        if buf is not None:
+            buf.close()
+
+def line_types(a):
+    """
+    a:      The uint8 array of the bytes of whole lines
+    return: (types, starts, ends) of every line, the end is where its
+            newline is. The type is the first column, -1 if that isn't
+            one or two digits.
     """
-    base_ms = 0
-    fraction = 0
-    buf = []
-    data = []
-    rule = re.compile("^%d," % signal_type)
+    ends = np.flatnonzero(a == NEWLINE)
+    if len(a) and a[-1] != NEWLINE:
+        ends = np.append(ends, len(a))
+    starts = np.concatenate(([0], ends[:-1] + 1)) if len(ends) else ends
 
-    for l in file_obj:
-        if not rule.match(l):
+    def byte(j):
+        """ The j-th byte of every line, reading past a line reads its newline first """
+        return a[np.minimum(starts + j, len(a) - 1)].astype(np.int16)
+    d0 = byte(0) - ZERO
+    d1 = byte(1) - ZERO
+    one = (d0 >= 0) & (d0 <= 9)
+    two = one & (d1 >= 0) & (d1 <= 9)
+    types = np.where(one & (d1 == COMMA - ZERO), d0,
+                     np.where(two & (byte(2) == COMMA), d0 * 10 + d1, -1))
+    return types, starts, ends
+
+def split_rows(text, signal_types):
+    """
+    Return {signal_type: 2-D int array} of the lines of the given signal
+    types in one pass.
+
+    The lines are selected by their first bytes with numpy. Only the runs
+    of consecutive lines of a type are sliced out, one run per second in
+    the files of the watch, and every type is decoded with one fromstring.
+    """
+    if not isinstance(text, bytes):
+        text = text.encode('ascii')
+    types, starts, ends = line_types(np.frombuffer(text, dtype=np.uint8))
+    rows = {}
+    for t in signal_types:
+        selected = np.concatenate(([0], types == t, [0])).astype(np.int8)
+        edges = np.flatnonzero(np.diff(selected))
+        # run i is the lines [first[i], last[i])
+        first = edges[::2]
+        last = edges[1::2]
+        if len(first) == 0:
+            rows[t] = decode_rows([])
             continue
+        runs = [text[s:e] for s, e in zip(starts[first].tolist(), ends[last - 1].tolist())]
+        joined = b','.join(runs).replace(b'\n', b',')
+        rows[t] = decode_values(joined, int(np.sum(last - first)))
+    return rows
+
+def decode_values(text, count):
+    """ Decode the comma separated values of count lines into a 2-D int array """
+    a = np.fromstring(text, dtype=np.int64, sep=',')
+    if len(a) % count != 0:
+        raise ValueError("Malformed raw data")
+    return a.reshape(count, -1)
 
-        a = l.rstrip("\n").split(',')
-        # extraction
-        if is_ecg(signal_type):
-            row = a[2:13]
-        elif is_ppg(signal_type):
-            row = a[2:13:2]
-
-        # timestamp calculation
-        new_base_ms = int(a[15]) * MSEC_PER_SEC
-        if base_ms == 0:
-	    base_ms = new_base_ms
-	elif base_ms != new_base_ms:
-            fraction = float(new_base_ms - base_ms) / len(buf)
-	    for i in range(0, len(buf)):
-                ts_ms = base_ms + (fraction * i)
-                # sanity check
-		if ts_ms >= new_base_ms:
-	            print "Error: timestamp equal to or larger than new base timestamp"
-                data.append((ts_ms, buf[i]))
-	    base_ms = new_base_ms
-	    buf[:] = []
-
-        for i in row:
-            if is_ecg(signal_type):
-                v = convert_ecg_to_mv(float(i))
-            elif is_ppg(signal_type):
-                v = convert_ppg_to_mv(float(i))
-            buf.append(v)
+def decode_rows(lines):
+    """ Decode lines into a 2-D int array, one row per line """
+    if not lines:
+        return np.empty((0, NUM_COLUMNS), dtype=np.int64)
+    return decode_values(','.join(lines), len(lines))
+
+def last_second_start(rows):
+    """ Return the index of the first row of the last second in rows """
+    ts = rows[:, TS_COLUMN]
+    changed = np.flatnonzero(ts[1:] != ts[:-1])
+    if len(changed) == 0:
+        return 0
+    return changed[-1] + 1
+
+def decode_signal(rows, signal_type, skip_ambient=True):
+    """
+    rows:         The 2-D int array from decode_rows()
+    signal_type:  0, 5, 9, or 12
+    skip_ambient: Keep every other ppg sample only, the rest is ambiance
+    return:       The numpy array of [timestamp, mv] rows, or the acc
+                  samples of decode_acc()
+    """
+    # extraction
+    if is_acc(signal_type):
+        return decode_acc(rows)
+    elif is_ecg(signal_type):
+        values = convert_ecg_array_to_mv(rows[:, 2:13])
+        per_row = values.shape[1]
+        values = values.ravel()
+    elif is_ppg(signal_type):
+        if skip_ambient:
+            values = convert_ppg_array_to_mv(rows[:, 2:13:2])
+        else:
+            values = convert_ppg_array_to_mv(rows[:, 2:13])
+        per_row = values.shape[1]
+        values = values.ravel()
+    else:
+        raise Exception("Unknown type")
 
+    # timestamp calculation
+    ts_ms = interpolate_ts(rows[:, TS_COLUMN] * MSEC_PER_SEC, per_row)
+    return np.column_stack((ts_ms, values[:len(ts_ms)]))
+
+def acc_ints(xyz):
+    """ Return acc samples as int16, or int32 when one doesn't fit in int16 """
+    fits = len(xyz) == 0 or (xyz.min() >= ACC_MIN and xyz.max() <= ACC_MAX)
+    return xyz.astype(np.int16 if fits else np.int32)
+
+def acc_dtype(xyz_dtype=np.int16):
+    """ The dtype of the acc samples, the timestamp (ms) and the x, y, z ints """
+    return np.dtype([('ts', np.float64), ('xyz', xyz_dtype, (3,))])
+
+def decode_acc(rows):
+    """
+    rows:   The 2-D int array of acc lines from decode_rows()
+    return: A structured array of the samples, 'ts' is the interpolated
+            timestamp (ms) and 'xyz' the int16 x, y, z of every sample
+
+    The samples stay integers as the sensor reports them, 14 bytes a
+    sample instead of 32 for float rows. int32 is used only when a sample
+    doesn't fit in int16.
+    """
+    xyz = acc_ints(rows[:, ACC_COLUMNS].reshape(-1, 3))
+    ts_ms = interpolate_ts(rows[:, TS_COLUMN] * MSEC_PER_SEC, 3)
+    data = np.empty(len(ts_ms), dtype=acc_dtype(xyz.dtype))
+    data['ts'] = ts_ms
+    data['xyz'] = xyz[:len(ts_ms)]
     return data
 
-#x = '12,20164,8380828,8380830,8380832,8380832,8380835,8380838,8380839,8380841,8380844,8380844,8380847,8380845,12345,1519268239'
-#parse_raw_ppg(x)
-#print ppg_data
+def signal_dtype(dtypes):
+    """ The dtype the arrays of one signal are joined as, acc samples are widened to int32 if one needs it """
+    dtypes = [np.dtype(d) for d in dtypes]
+    if dtypes[0].names:
+        return acc_dtype(np.result_type(*[d['xyz'].base for d in dtypes]))
+    return np.result_type(*dtypes)
+
+def concat_signals(arrays):
+    """ np.concatenate() the arrays of one signal, see signal_dtype() """
+    dtype = signal_dtype([a.dtype for a in arrays])
+    return np.concatenate([a.astype(dtype, copy=False) for a in arrays])
+
+def signal_ts(data):
+    """ The timestamps (ms) of the samples of a signal """
+    if data.dtype.names:
+        return data['ts']
+    return data[:,0]
+
+def empty_signal(signal_type, skip_ambient=True):
+    """ The array decode_signal() returns when a signal has no samples """
+    return decode_signal(decode_rows([]), signal_type, skip_ambient)
+
+class SignalDecoder(object):
+    """
+    Decode blocks of whole lines into {signal_type: decode(rows, signal_type)}
+    chunks of whole seconds. The rows of the last second of a block are
+    kept in `pending` until the next per-second timestamp shows up, so the
+    chunks concatenate to the same arrays as decoding all lines at once.
+    """
+    def __init__(self, signal_types, decode):
+        self.signal_types = signal_types
+        self.decode = decode
+        self.pending = dict((t, None) for t in signal_types)
+
+    def feed(self, block):
+        block_rows = split_rows(block, self.signal_types)
+        chunk = {}
+        for t in self.signal_types:
+            rows = block_rows[t]
+            if self.pending[t] is not None and len(self.pending[t]):
+                rows = np.concatenate((self.pending[t], rows))
+            chunk[t] = self.decode(rows, t)
+            self.pending[t] = rows[last_second_start(rows):]
+        return chunk
+
+def iter_decoded(file_obj, signal_types, decode, block_size=BLOCK_SIZE, use_mmap=False):
+    """ Yield the chunks of a SignalDecoder fed with the blocks of a file """
+    decoder = SignalDecoder(signal_types, decode)
+    for block in iter_blocks(file_obj, block_size, use_mmap):
+        yield decoder.feed(block)
+
+def iter_signals(file_obj, signal_types=ALL_TYPES, block_size=BLOCK_SIZE, use_mmap=False,
+                 skip_ambient=True):
+    """
+    file_obj:     The file obj come from open() or io.BytesIO
+    signal_types: The signal types to keep, e.g. (TYPE_ECG, TYPE_PPG512)
+    block_size:   The number of bytes read at a time
+    use_mmap:     Read through mmap, file_obj must be a real file
+    skip_ambient: See decode_signal()
+    return:       A generator of {signal_type: numpy array} chunks
+
+    The rows of the last second of a block are kept until the next
+    per-second timestamp shows up, so the chunks concatenate to the same
+    arrays as parsing the whole file at once.
+    """
+    decode = lambda rows, t: decode_signal(rows, t, skip_ambient)
+    return iter_decoded(file_obj, signal_types, decode, block_size, use_mmap)
+
+def parse_signals(file_obj, signal_types=ALL_TYPES, block_size=BLOCK_SIZE, use_mmap=False,
+                  skip_ambient=True):
+    """
+    file_obj:     The file obj come from open() or io.BytesIO
+    signal_types: The signal types to keep, e.g. (TYPE_ECG, TYPE_PPG512)
+    skip_ambient: See decode_signal()
+    return:       {signal_type: numpy array} as decode_signal() returns
+
+    The file is read only once no matter how many types are kept, and the
+    raw text never has to be held in memory as a whole.
+    """
+    chunks = dict((t, []) for t in signal_types)
+    for chunk in iter_signals(file_obj, signal_types, block_size, use_mmap, skip_ambient):
+        for t in signal_types:
+            chunks[t].append(chunk[t])
+
+    signals = {}
+    for t in signal_types:
+        if len(chunks[t]) == 1:
+            signals[t] = chunks[t][0]
+        elif chunks[t]:
+            signals[t] = concat_signals(chunks[t])
+        else:
+            signals[t] = empty_signal(t, skip_ambient)
+    return signals
+
+def parse_data(file_obj, signal_type):
+    """
+    file_obj:    The file obj come from open() or io.BytesIO
+    signal_type: 0, 5, 9, or 12
+    return:      The numpy array of [timestamp, mv] rows
+    """
+    return parse_signals(file_obj, (signal_type,))[signal_type]
@@ -1,9 +1,19 @@
-import matplotlib.pyplot as plot
 import numpy as np
+from matplotlib import cm
+from matplotlib.lines import Line2D
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.transforms import Affine2D
 from scipy import signal
+from filters import power_line_noise_sos, high_pass_sos, low_pass_sos, values_of
+from pyramid import build_pyramid
+from spectral import amplitude_spectrum, welch_psd, spectrogram, SPECTRUM_KINDS
 
 PNG_W_INCH = 18
 PNG_H_INCH = 8
+PNG_DPI = 100
+ECG_NUM_SEG = 4
 
 MV_LOW_BOUND = -1.5
 MV_HIGH_BOUND = 1.5
@@ -11,14 +21,48 @@ MV_STEP = 0.5
 
 MS_STEP = 200
 
+# lines shorter than this are plotted as they are
+DECIMATE_MIN_POINTS = 10000
+
 def plot_freq_domain(ax, data, fs, color='b'):
-    win = len(data)
-    half = win / 2
-    amp = np.abs(np.fft.fft(data)) / float(win)
-    amp = amp[:half]
-    band = np.fft.fftfreq(win, 1/float(fs))
-    band = band[:half]
-    ax.plot(band, 20. * np.log10(amp), color)
+    freqs, amp = amplitude_spectrum(data, fs)
+    mag_db = 20. * np.log10(amp)
+    if len(freqs) > DECIMATE_MIN_POINTS:
+        plot_decimated(ax, freqs, mag_db, color)
+    else:
+        ax.plot(freqs, mag_db, color)
+
+def plot_psd(ax, data, fs, color='b'):
+    freqs, psd = welch_psd(data, fs)
+    ax.plot(freqs, 10. * np.log10(psd), color)
+    ax.set_xlabel("Frequency (Hz)")
+    ax.set_ylabel("PSD (dB/Hz)")
+
+def plot_spectrogram(ax, data, fs):
+    """
+    data: [timestamp, value] rows, or values
+    The x axis is the epoch time (ms) of rows, or seconds of values.
+    """
+    freqs, times, sxx = spectrogram([data], fs)
+    if len(times) == 0:
+        return
+    sxx_db = 10. * np.log10(np.maximum(sxx, np.finfo(np.float64).tiny))
+    ax.imshow(sxx_db, aspect='auto', origin='lower', cmap='viridis',
+              extent=(times[0], times[-1], freqs[0], freqs[-1]))
+    ax.set_xlabel("Epoch Time (ms)" if np.ndim(data) == 2 else "Time (s)")
+    ax.set_ylabel("Frequency (Hz)")
+
+def plot_spectrum(ax, data, fs, kind='fft', color='b'):
+    """
+    data: [timestamp, value] rows
+    kind: "fft", "welch" or "spectrogram", see SPECTRUM_KINDS
+    """
+    if kind == 'spectrogram':
+        plot_spectrogram(ax, data, fs)
+    elif kind == 'welch':
+        plot_psd(ax, values_of(data), fs, color)
+    else:
+        plot_freq_domain(ax, values_of(data), fs, color)
 
 def plot_filter(ax, fs, w, h, color=None):
     """
@@ -32,33 +76,114 @@ def plot_filter(ax, fs, w, h, color=None):
     ax.plot(freq, mag_db, color=color)
 
 def plot_power_line_noise_filter(ax, fs):
-    f0 = 65.0
-    Q = 30.0
-    w0 = f0 / (fs/2)
-    b, a = signal.iirnotch(w0, Q)
-    w, h = signal.freqz(b, a)
+    w, h = signal.sosfreqz(power_line_noise_sos(fs))
     plot_filter(ax, fs, w, h, color='c')
 
 def plot_high_pass_filter(ax, fs, cutoff):
-    nyq = fs / 2.0
-    normalized_cutoff = cutoff / nyq
-    b, a = signal.butter(3, normalized_cutoff, btype="highpass", analog=False)
-    w, h = signal.freqz(b, a)
+    w, h = signal.sosfreqz(high_pass_sos(fs, cutoff))
     plot_filter(ax, fs, w, h, color='y')
 
 def plot_low_pass_filter(ax, fs, cutoff):
-    nyq = fs / 2.0
-    normalized_cutoff = cutoff / nyq
-    b, a = signal.butter(3, normalized_cutoff, btype="lowpass", analog=False)
-    w, h = signal.freqz(b, a)
+    w, h = signal.sosfreqz(low_pass_sos(fs, cutoff))
     plot_filter(ax, fs, w, h, color='r')
 
-def plot_time_domain(ax, data, color='b'):
-    ax.plot(data[:,0], data[:,1], color)
+def minmax_decimate(x, y, num_buckets):
+    """
+    Keep the min and the max of every bucket in their original order, so
+    peaks like R-waves survive. The first and the last points are kept too.
+    """
+    n = len(x)
+    if n <= 2 * num_buckets + 2:
+        return x, y
+    k = int(np.ceil(n / float(num_buckets)))
+    m = (n // k) * k
+    buckets = y[:m].reshape(-1, k)
+    start = np.arange(0, m, k)
+    imin = start + np.argmin(buckets, axis=1)
+    imax = start + np.argmax(buckets, axis=1)
+    idx = [np.sort(np.column_stack((imin, imax)), axis=1).ravel()]
+    if m < n:
+        # the last bucket is shorter
+        tail = y[m:]
+        idx.append(np.sort([m + np.argmin(tail), m + np.argmax(tail)]))
+    idx = np.concatenate([[0]] + idx + [[n - 1]])
+    return x[idx], y[idx]
+
+def on_xlim_changed(ax, update):
+    """
+    Call update(axes) whenever the x limits of ax change. set_xlim() only
+    notifies the axes it is called on, so the axes sharing x with ax are
+    connected too, the axes passed is the one with the new limits.
+    """
+    for other in ax.get_shared_x_axes().get_siblings(ax):
+        other.callbacks.connect('xlim_changed', update)
+
+def plot_decimated(ax, x, y, color='b'):
+    """
+    Plot about two points per pixel of the axes width. The visible range is
+    decimated again whenever the x limits change, e.g. on zoom or pan.
+    """
+    def num_buckets():
+        return max(int(ax.get_window_extent().width), 1)
+
+    line, = ax.plot(*minmax_decimate(x, y, num_buckets()), color=color)
+    if np.any(np.diff(x) < 0):
+        # can't look up the visible range of unsorted data
+        return line
+
+    def update(changed):
+        lo, hi = changed.get_xlim()
+        # one more point on each side so the line reaches the edges
+        start = max(np.searchsorted(x, lo) - 1, 0)
+        end = min(np.searchsorted(x, hi) + 1, len(x))
+        line.set_data(*minmax_decimate(x[start:end], y[start:end], num_buckets()))
+
+    on_xlim_changed(ax, update)
+    return line
+
+def plot_pyramid(ax, pyramid, color='b'):
+    """
+    Plot a pyramid.Pyramid with about two points per pixel of the axes
+    width. The level matching the visible span is picked again whenever
+    the x limits change, so a zoom or pan costs the same at any span.
+    """
+    def max_points():
+        return 2 * max(int(ax.get_window_extent().width), 1)
+
+    line, = ax.plot(*pyramid.visible(pyramid.ts[0], pyramid.ts[-1], max_points()), color=color)
+
+    def update(changed):
+        lo, hi = changed.get_xlim()
+        line.set_data(*pyramid.visible(lo, hi, max_points()))
+
+    on_xlim_changed(ax, update)
+    return line
+
+def plot_time_domain(ax, data, color='b', pyramid=None):
+    """
+    Plot [timestamp, value] rows, long rows through a pyramid.Pyramid,
+    which is built here unless one is given
+    """
+    if pyramid is None and len(data) > DECIMATE_MIN_POINTS and np.all(np.diff(data[:,0]) >= 0):
+        pyramid = build_pyramid(data[:,0], data[:,1])
+    if pyramid is not None:
+        plot_pyramid(ax, pyramid, color)
+    elif len(data) > DECIMATE_MIN_POINTS:
+        plot_decimated(ax, data[:,0], data[:,1], color)
+    else:
+        ax.plot(data[:,0], data[:,1], color)
     ax.set_xlabel("Epoch Time (ms)")
     ax.set_ylabel("MV")
 
+def plot_r_peaks(ax, peaks, color='r'):
+    """ Mark the [timestamp, mv] rows of the R peaks, e.g. from hrv.detect_r_peaks() """
+    if len(peaks) == 0:
+        return
+    ax.plot(peaks[:,0], peaks[:,1], linestyle='None', marker='o', markersize=4, color=color)
+
 def plot_ecg(data):
+    # pyplot loads the GUI backend, only the functions drawing on pyplot figures import it
+    import matplotlib.pyplot as plot
     figsize = plot.rcParams['figure.figsize']
     figsize[0] = PNG_W_INCH
     figsize[1] = PNG_H_INCH
@@ -88,14 +213,109 @@ def plot_ecg(data):
     plot.tight_layout(pad=0.3, h_pad = 0.2)
 
 def plot_to_png(png_name):
+    import matplotlib.pyplot as plot
     plot.savefig(png_name)
 
+class EcgRenderer(object):
+    """
+    Render ecg data to png like plot_ecg() and plot_to_png(), without pyplot.
+
+    The Agg figure, the axes, the mV grid and the layout are built once and
+    reused. The 0.2s grid is kept relative to the start of a segment and
+    only shifted, it is rebuilt only for a longer segment than seen before.
+    Only the line data and the x range change per recording, and nothing
+    of a recording is kept after render() returns, so memory stays flat.
+    """
+    def __init__(self, num_seg=ECG_NUM_SEG):
+        self.fig = Figure(figsize=(PNG_W_INCH, PNG_H_INCH), dpi=PNG_DPI)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.laid_out = False
+        self.grid_ms = 0
+        self.axes = []
+        self.lines = []
+        self.vgrids = []
+        # horizontal lines every 0.5 mV
+        hl = np.arange(MV_LOW_BOUND, MV_HIGH_BOUND, MV_STEP)
+        for i in range(0, num_seg):
+            ax = self.fig.add_subplot(num_seg, 1, i + 1)
+            ax.set_ylim(MV_LOW_BOUND, MV_HIGH_BOUND)
+            # disable autoscale since it will be difficult to compare, e.g., RR interval.
+            ax.autoscale(False)
+            ax.hlines(hl, 0, 1, transform=ax.get_yaxis_transform(), color='r', alpha=0.2)
+            vgrid = LineCollection([], colors='r', alpha=0.2)
+            ax.add_collection(vgrid)
+            line, = ax.plot([], [], color='black')
+            ax.set_xlabel("Epoch Time (ms)")
+            ax.set_ylabel("MV")
+            self.axes.append(ax)
+            self.lines.append(line)
+            self.vgrids.append(vgrid)
+
+    def update_grid(self, duration_ms):
+        """ Make the 0.2s grid, relative to the segment start, long enough """
+        if duration_ms <= self.grid_ms:
+            return
+        # vertical lines every 0.2s
+        vl = np.arange(0, duration_ms, MS_STEP)
+        segments = np.empty((len(vl), 2, 2))
+        segments[:,:,0] = vl[:,np.newaxis]
+        segments[:,0,1] = MV_LOW_BOUND
+        segments[:,1,1] = MV_HIGH_BOUND
+        for vgrid in self.vgrids:
+            vgrid.set_segments(segments)
+        self.grid_ms = duration_ms
+
+    def render(self, data, png_name):
+        s = np.array_split(data, len(self.axes))
+        self.update_grid(max(seg[-1][0] - seg[0][0] for seg in s))
+        for i in range(0, len(self.axes)):
+            start_ts = s[i][0][0]
+            end_ts = s[i][-1][0]
+            self.axes[i].set_xlim(start_ts, end_ts)
+            # lines past end_ts are clipped by the axes
+            self.vgrids[i].set_transform(Affine2D().translate(start_ts, 0) + self.axes[i].transData)
+            width = max(int(self.axes[i].get_window_extent().width), 1)
+            self.lines[i].set_data(*minmax_decimate(s[i][:,0], s[i][:,1], width))
+
+        if not self.laid_out:
+            # adjust layout once, the tick labels of epoch time look alike
+            self.fig.tight_layout(pad=0.3, h_pad = 0.2)
+            self.laid_out = True
+        self.fig.savefig(png_name)
+
+        for i in range(0, len(self.axes)):
+            self.lines[i].set_data([], [])
+
+# one renderer per process, see render_ecg_png()
+ecg_renderer = None
+
+def render_ecg_png(data, png_name):
+    """ Headless and faster plot_ecg() followed by plot_to_png() """
+    global ecg_renderer
+    if ecg_renderer is None:
+        ecg_renderer = EcgRenderer()
+    ecg_renderer.render(data, png_name)
+
 def plot_annotation(ax, data):
+    if not data:
+        return
     # randomize the color of vertical lines
-    cmap = plot.cm.get_cmap('hsv', len(data))
-    for i in range(0, len(data)):
-        ms = data[i][0]
-        label = data[i][1]
-        ax.axvline(ms, label=label, color=cmap(i), ls='dashed')
+    cmap = cm.get_cmap('hsv', len(data))
+    colors = [cmap(i) for i in range(0, len(data))]
+    ms = np.asarray([d[0] for d in data], dtype=float)
+    # one collection for all lines, spanning the whole height like axvline.
+    # The y of the lines are in axes coordinates, so only the x data limits
+    # are updated, or the y limits would be stretched to include 0 and 1
+    segments = np.stack([np.column_stack((ms, np.zeros(len(ms)))),
+                         np.column_stack((ms, np.ones(len(ms))))], axis=1)
+    lc = LineCollection(segments, colors=colors, linestyles='dashed',
+                        transform=ax.get_xaxis_transform())
+    ax.add_collection(lc, autolim=False)
+    ax.dataLim.update_from_data_xy(np.column_stack((ms, ms)), ax.ignore_existing_data_limits,
+                                   updatey=False)
+    ax.ignore_existing_data_limits = False
+    ax.autoscale_view(scaley=False)
     # make label work
-    ax.legend()
+    handles = [Line2D([], [], color=colors[i], ls='dashed', label=data[i][1])
+               for i in range(0, len(data))]
+    ax.legend(handles=handles)
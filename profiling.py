@@ -0,0 +1,110 @@
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# the CPU time of the calling thread, so stages running on other threads
+# aren't counted, python 2 doesn't name the linux constant
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD',
+                        1 if sys.platform.startswith('linux') else resource.RUSAGE_SELF)
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """ The peak resident memory of this process so far, or of its largest child with RUSAGE_CHILDREN """
+    peak = resource.getrusage(who).ru_maxrss
+    # bytes on macOS, KB elsewhere
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+def current_rss_mb():
+    """ The resident memory of this process now, or the peak where unknown """
+    try:
+        f = open('/proc/self/statm')
+        pages = int(f.read().split()[1])
+        f.close()
+        return pages * resource.getpagesize() / (1024.0 * 1024.0)
+    except (IOError, OSError):
+        return peak_rss_mb()
+
+def cpu_seconds():
+    usage = resource.getrusage(RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+def size_of(x):
+    """ {"bytes", "shape"} of a numpy array, {"len"} of a sequence, or None """
+    if hasattr(x, 'nbytes') and hasattr(x, 'shape'):
+        return {"bytes": int(x.nbytes), "shape": list(x.shape)}
+    if isinstance(x, dict):
+        return dict((str(k), size_of(v)) for k, v in x.items())
+    try:
+        return {"len": len(x)}
+    except TypeError:
+        return None
+
+class StageProfiler(object):
+    """
+    Record the wall time, CPU time, input and output sizes and memory of
+    pipeline stages per signal, e.g.
+
+        profiler = StageProfiler()
+        Observable.just(data).map(profiler.wrap('filter', 'ecg', ecg_filter))
+        with profiler.measure('parse', 'all'):
+            ...
+        profiler.save('profile.json')
+
+    A disabled profiler returns the stages as they are, so it costs nothing.
+    The CPU time is per thread, the memory is of the whole process.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.records = []
+
+    def wrap(self, stage, signal, fn):
+        """ Return fn(x) that records a stage every time it is called """
+        if not self.enabled:
+            return fn
+        def profiled(x):
+            with self.measure(stage, signal, x) as record:
+                y = fn(x)
+                record["output"] = size_of(y)
+            return y
+        return profiled
+
+    @contextmanager
+    def measure(self, stage, signal, input=None):
+        """ Record the code of a with block as a stage, yield the record """
+        record = {"stage": stage, "signal": signal, "thread": threading.current_thread().name}
+        if not self.enabled:
+            yield record
+            return
+        record["input"] = size_of(input)
+        rss = current_rss_mb()
+        peak = peak_rss_mb()
+        cpu = cpu_seconds()
+        start = time.time()
+        try:
+            yield record
+        finally:
+            record["wall_seconds"] = time.time() - start
+            record["cpu_seconds"] = cpu_seconds() - cpu
+            record["rss_delta_mb"] = current_rss_mb() - rss
+            # only a stage that sets a new high-water mark raises the peak
+            record["peak_rss_mb"] = peak_rss_mb()
+            record["peak_growth_mb"] = record["peak_rss_mb"] - peak
+            self.records.append(record)
+
+    def totals(self):
+        """ The wall and CPU seconds summed per stage """
+        totals = {}
+        for r in self.records:
+            t = totals.setdefault(r["stage"], {"wall_seconds": 0.0, "cpu_seconds": 0.0})
+            t["wall_seconds"] += r["wall_seconds"]
+            t["cpu_seconds"] += r["cpu_seconds"]
+        return totals
+
+    def save(self, path, **extra):
+        report = {"stages": self.records, "totals": self.totals()}
+        report.update(extra)
+        f = open(path, "w")
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.close()
@@ -0,0 +1,109 @@
+import numpy as np
+
+# bump when the levels change to invalidate the cached pyramids
+PYRAMID_VERSION = 2
+# every level has FACTOR times fewer buckets than the one below, all
+# levels together take about 3 bytes per sample
+PYRAMID_FACTOR = 8
+# no coarser level is built once a level has this few buckets
+PYRAMID_MIN_BUCKETS = 1024
+# the arrays of a level, the timestamp of the first sample of every
+# bucket and the min, max and mean of its values
+LEVEL_FIELDS = ('start', 'min', 'max', 'mean')
+VALUE_DTYPE = np.float32
+
+def build_level(start_ts, mins, maxs, sums, counts, factor):
+    """ Return (level, counts) of every factor buckets of the level below merged into one """
+    idx = np.arange(0, len(start_ts), factor)
+    count = np.add.reduceat(counts, idx)
+    level = {"start": start_ts[idx],
+             "min": np.minimum.reduceat(mins, idx),
+             "max": np.maximum.reduceat(maxs, idx),
+             "mean": (np.add.reduceat(sums, idx) / count).astype(VALUE_DTYPE)}
+    return level, count
+
+class Pyramid(object):
+    """
+    Min, max and mean of the values per bucket of FACTOR**k samples at
+    level k, so a plot of any span draws about as many points as it has
+    pixels. Level 0 is the samples themselves, which may be memory-mapped,
+    they are only read when a span is zoomed in far enough to show them.
+
+    The timestamps must be sorted.
+    """
+    def __init__(self, ts, values, levels, factor=PYRAMID_FACTOR):
+        self.ts = ts
+        self.values = values
+        self.levels = levels
+        self.factor = factor
+
+    def visible(self, lo, hi, max_points):
+        """
+        Return (x, y) to plot for the span [lo, hi], at most about
+        max_points points. A bucket is drawn as a vertical stroke from its
+        min to its max.
+        """
+        begin, end = np.searchsorted(self.ts, (lo, hi))
+        samples = end - begin
+        if samples <= max_points or not self.levels:
+            # one more point on each side so the line reaches the edges
+            begin = max(begin - 1, 0)
+            end = min(end + 1, len(self.ts))
+            return self.ts[begin:end], self.values[begin:end]
+
+        level = self.levels[-1]
+        size = self.factor
+        for l in self.levels:
+            if samples // size <= max_points // 2:
+                level = l
+                break
+            size *= self.factor
+        begin = max(np.searchsorted(level["start"], lo, 'right') - 2, 0)
+        end = min(np.searchsorted(level["start"], hi) + 1, len(level["start"]))
+        start = level["start"][begin:end]
+        x = np.repeat(start, 2)
+        y = np.column_stack((level["min"][begin:end], level["max"][begin:end])).ravel()
+        return x, y
+
+    def to_arrays(self):
+        """ {name: array} of the levels, e.g. for numpy.savez() """
+        arrays = {"factor": np.array(self.factor)}
+        for k, level in enumerate(self.levels):
+            for name in LEVEL_FIELDS:
+                arrays["%d_%s" % (k + 1, name)] = level[name]
+        return arrays
+
+def pyramid_from_arrays(ts, values, arrays):
+    """ The Pyramid of to_arrays(), over the samples it was built from """
+    levels = []
+    k = 1
+    while "%d_start" % k in arrays:
+        levels.append(dict((name, arrays["%d_%s" % (k, name)]) for name in LEVEL_FIELDS))
+        k += 1
+    return Pyramid(ts, values, levels, int(arrays["factor"]))
+
+def build_pyramid(ts, values, factor=PYRAMID_FACTOR, min_buckets=PYRAMID_MIN_BUCKETS):
+    """
+    ts:          The sorted timestamps of the samples
+    values:      The values of the samples
+    factor:      The samples per bucket of level 1, and buckets per
+                 bucket of every level above
+    min_buckets: Stop once a level has no more buckets than this
+    return:      The Pyramid of the samples
+
+    Every level is reduced from the one below, so building all of them
+    costs little more than one pass over the samples.
+    """
+    ts = np.asarray(ts)
+    values = np.asarray(values)
+    levels = []
+    if len(values):
+        v = values.astype(VALUE_DTYPE)
+        level, count = build_level(ts, v, v, values.astype(np.float64),
+                                   np.ones(len(v), dtype=np.int64), factor)
+        levels.append(level)
+        while len(level["start"]) > min_buckets:
+            level, count = build_level(level["start"], level["min"], level["max"],
+                                       level["mean"] * count, count, factor)
+            levels.append(level)
+    return Pyramid(ts, values, levels, factor)
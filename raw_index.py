@@ -0,0 +1,252 @@
+import datetime
+import hashlib
+import io
+import os
+import tempfile
+import time
+import numpy as np
+
+from parser import parse_signals, signal_ts, BLOCK_SIZE, MSEC_PER_SEC, NEWLINE, COMMA, ZERO
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.idx.npz'
+# a file whose first bytes changed has been replaced, not appended to
+HEAD_SIZE = 4096
+
+def index_path(raw_path):
+    return raw_path + INDEX_SUFFIX
+
+def head_digest(raw_path, size):
+    f = open(raw_path, 'rb')
+    head = f.read(size)
+    f.close()
+    return hashlib.sha1(head).hexdigest()
+
+def digits_to_int(a, begin, end):
+    """ Decode the decimal digits a[begin:end] of every line at once """
+    width = end - begin
+    value = np.zeros(len(begin), dtype=np.int64)
+    for j in range(int(width.max()) if len(width) else 0):
+        has = j < width
+        d = a[np.where(has, begin + j, 0)].astype(np.int64) - ZERO
+        value = np.where(has, value * 10 + d, value)
+    return value
+
+def scan_lines(buf):
+    """
+    buf:    bytes of whole lines
+    return: (types, seconds, offsets) of every line, the offsets are
+            relative to buf
+
+    Only the first and the last column of a line are decoded, with numpy
+    on the raw bytes, so scanning is much faster than parsing.
+    """
+    a = np.frombuffer(buf, dtype=np.uint8)
+    ends = np.flatnonzero(a == NEWLINE)
+    starts = np.concatenate(([0], ends[:-1] + 1)).astype(np.int64)
+    # ignore \r of \r\n and empty lines
+    if len(ends):
+        ends = ends - (a[np.maximum(ends - 1, 0)] == ord('\r'))
+    keep = ends > starts
+    starts = starts[keep]
+    ends = ends[keep]
+
+    commas = np.flatnonzero(a == COMMA)
+    i_first = np.searchsorted(commas, starts)
+    i_last = np.searchsorted(commas, ends) - 1
+    if np.any(i_first >= len(commas)) or np.any(i_last < i_first):
+        raise ValueError("Malformed raw data")
+    first = commas[i_first]
+    last = commas[i_last]
+    if np.any(first >= ends) or np.any(last < starts):
+        raise ValueError("Malformed raw data")
+    return digits_to_int(a, starts, first), digits_to_int(a, last + 1, ends), starts
+
+class RawIndex(object):
+    """
+    The byte offset of the first line of every second of every signal type
+    in a raw data file, i.e. where the per-second timestamp (the last
+    column) of the lines of a type changes.
+
+    The index is saved next to the raw data file as <file>.idx.npz. When
+    the file has grown, only the appended lines are scanned. Timestamps
+    are expected to never go backward within a type.
+    """
+    def __init__(self, raw_path):
+        self.raw_path = raw_path
+        self.clear()
+
+    def clear(self):
+        # [type, second, offset] rows
+        self.entries = np.empty((0, 3), dtype=np.int64)
+        self.indexed_bytes = 0
+        # the digest of the first head_size bytes
+        self.head = None
+        self.head_size = 0
+        self.lookup = {}
+
+    def load(self):
+        """ Read the saved index, return False if there is none usable """
+        path = index_path(self.raw_path)
+        if not os.path.exists(path):
+            return False
+        z = np.load(path)
+        try:
+            if int(z['version']) != INDEX_VERSION:
+                return False
+            self.entries = z['entries']
+            self.indexed_bytes = int(z['indexed_bytes'])
+            self.head = str(z['head'])
+            self.head_size = int(z['head_size'])
+        finally:
+            z.close()
+        self.lookup = {}
+        return True
+
+    def save(self):
+        """ Save the index, it is only kept in memory if the folder is read-only """
+        path = index_path(self.raw_path)
+        try:
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+        except (IOError, OSError):
+            return
+        f = os.fdopen(fd, 'wb')
+        np.savez(f, version=INDEX_VERSION, entries=self.entries,
+                 indexed_bytes=self.indexed_bytes, head=self.head, head_size=self.head_size)
+        f.close()
+        os.rename(tmp, path)
+
+    def update(self, block_size=BLOCK_SIZE):
+        """ Scan what was appended to the file since the last update """
+        size = os.path.getsize(self.raw_path)
+        if size < self.indexed_bytes or (self.head is not None and
+                                         head_digest(self.raw_path, self.head_size) != self.head):
+            # replaced rather than appended to
+            self.clear()
+        if size == self.indexed_bytes:
+            return False
+
+        # the last second seen of every type
+        last = {}
+        for t in np.unique(self.entries[:,0]):
+            last[int(t)] = int(self.entries[self.entries[:,0] == t, 1].max())
+        new_entries = [self.entries]
+        f = open(self.raw_path, 'rb')
+        f.seek(self.indexed_bytes)
+        while True:
+            block = f.read(block_size)
+            end = block.rfind(b'\n') + 1
+            if end == 0:
+                # the end, or a line still being written
+                break
+            f.seek(self.indexed_bytes + end)
+            types, seconds, offsets = scan_lines(block[:end])
+            new_entries.append(self.first_lines(types, seconds, offsets + self.indexed_bytes, last))
+            self.indexed_bytes += end
+        f.close()
+
+        self.entries = np.concatenate(new_entries)
+        if self.head_size < HEAD_SIZE:
+            self.head_size = min(self.indexed_bytes, HEAD_SIZE)
+            self.head = head_digest(self.raw_path, self.head_size)
+        self.lookup = {}
+        return True
+
+    def first_lines(self, types, seconds, offsets, last):
+        """ Return the entries of the lines that start a new second of their type """
+        entries = []
+        for t in np.unique(types):
+            mask = types == t
+            s = seconds[mask]
+            o = offsets[mask]
+            prev = np.concatenate(([last.get(int(t), -1)], s[:-1]))
+            new = s != prev
+            entries.append(np.column_stack((np.full(np.count_nonzero(new), t, dtype=np.int64),
+                                            s[new], o[new])))
+            last[int(t)] = int(s[-1])
+        if not entries:
+            return np.empty((0, 3), dtype=np.int64)
+        return np.concatenate(entries)
+
+    def seconds_of(self, signal_type):
+        """ Return (seconds, offsets) of a type, sorted by offset """
+        if signal_type not in self.lookup:
+            e = self.entries[self.entries[:,0] == signal_type]
+            e = e[np.argsort(e[:,2], kind='mergesort')]
+            self.lookup[signal_type] = (e[:,1], e[:,2])
+        return self.lookup[signal_type]
+
+    def first_second(self):
+        """ The first per-second timestamp of the file, or None """
+        if len(self.entries) == 0:
+            return None
+        return int(self.entries[np.argmin(self.entries[:,2]), 1])
+
+    def byte_range(self, signal_type, start_ms, end_ms):
+        """
+        Return (begin, end) offsets of the lines of signal_type needed for
+        the samples in [start_ms, end_ms). The lines of the second after
+        end_ms are included too, the timestamps of the last second of a
+        window can't be interpolated without them.
+        """
+        seconds, offsets = self.seconds_of(signal_type)
+        if len(seconds) == 0:
+            return 0, 0
+        first = np.searchsorted(seconds, start_ms // MSEC_PER_SEC, 'right') - 1
+        last = np.searchsorted(seconds, (end_ms - 1) // MSEC_PER_SEC, 'right')
+        begin = offsets[max(first, 0)]
+        end = offsets[last + 1] if last + 1 < len(offsets) else self.indexed_bytes
+        return int(begin), int(end)
+
+def load_index(raw_path):
+    """ Return the RawIndex of a raw data file, built or updated as needed """
+    index = RawIndex(raw_path)
+    index.load()
+    if index.update():
+        index.save()
+    return index
+
+def read_window(raw_path, signal_types, start_ms, end_ms, skip_ambient=True, index=None):
+    """
+    raw_path:     The raw data file
+    signal_types: The signal types to read, e.g. (TYPE_ECG, TYPE_PPG512)
+    start_ms:     The epoch time (ms) of the first sample
+    end_ms:       The epoch time (ms) the window ends before
+    skip_ambient: See parser.decode_signal()
+    index:        The RawIndex of the file, loaded if None
+    return:       {signal_type: numpy array} as parser.parse_signals() returns
+
+    Only the lines around the window are read and parsed, so a one minute
+    window of a long recording opens in milliseconds.
+    """
+    if index is None:
+        index = load_index(raw_path)
+    signals = {}
+    f = open(raw_path, 'rb')
+    for t in signal_types:
+        begin, end = index.byte_range(t, start_ms, end_ms)
+        f.seek(begin)
+        data = parse_signals(io.BytesIO(f.read(end - begin)), (t,), skip_ambient=skip_ambient)[t]
+        ts = signal_ts(data)
+        signals[t] = data[(ts >= start_ms) & (ts < end_ms)]
+    f.close()
+    return signals
+
+def parse_time(s, first_second=None):
+    """
+    s:            Epoch time (ms), "YYYY/MM/DD HH:MM:SS" like the annotation
+                  file, or "HH:MM:SS" on the day the recording starts
+    first_second: The first per-second timestamp of the recording
+    return:       The epoch time (ms)
+    """
+    if s.isdigit():
+        return int(s)
+    try:
+        dt = datetime.datetime.strptime(s, "%Y/%m/%d %H:%M:%S")
+    except ValueError:
+        if first_second is None:
+            raise
+        day = datetime.datetime.fromtimestamp(first_second).date()
+        clock = datetime.datetime.strptime(s, "%H:%M:%S").time()
+        dt = datetime.datetime.combine(day, clock)
+    return int(time.mktime(dt.timetuple()) * MSEC_PER_SEC)
@@ -0,0 +1,138 @@
+import numpy as np
+from scipy import signal
+from scipy.fftpack import next_fast_len
+
+from filters import values_of, concat, POWER_LINE_FREQ
+
+# the length of a welch or spectrogram segment
+WELCH_SEGMENT_SEC = 4
+SPECTROGRAM_SEGMENT_SEC = 2
+SPECTROGRAM_WINDOW = 'hann'
+# the half width of the power line band in spectral_summary()
+POWER_LINE_BAND_HZ = 1.0
+# what plots.plot_spectrum() can show
+SPECTRUM_KINDS = ('fft', 'welch', 'spectrogram')
+
+def amplitude_spectrum(data, fs):
+    """
+    data:   The values of a real signal
+    fs:     The sampling rate (Hz)
+    return: (freqs, amplitudes) of the one-sided spectrum, |X| / len(data)
+
+    A real-input FFT only computes the non-negative frequencies, and the
+    input is zero-padded to a length with small prime factors, which is
+    much faster than an arbitrary length.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if len(data) == 0:
+        return np.empty((0,)), np.empty((0,))
+    nfft = next_fast_len(len(data))
+    amp = np.abs(np.fft.rfft(data, nfft)) / float(len(data))
+    return np.fft.rfftfreq(nfft, 1.0 / fs), amp
+
+def welch_psd(data, fs, nperseg=None):
+    """
+    data:    The values of a real signal
+    fs:      The sampling rate (Hz)
+    nperseg: The length of a segment, WELCH_SEGMENT_SEC by default
+    return:  (freqs, power spectral density) averaged over half-overlapping
+             segments, much less noisy than a single FFT
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if len(data) == 0:
+        return np.empty((0,)), np.empty((0,))
+    nperseg = min(nperseg or int(WELCH_SEGMENT_SEC * fs), len(data))
+    return signal.welch(data, fs, nperseg=nperseg)
+
+class Spectrogram(object):
+    """
+    A spectrogram computed one segment at a time from chunked input.
+
+    Chunks are numpy arrays of values or of [timestamp, value] rows, e.g.
+    from parser.iter_signals(). Samples that don't fill a segment yet are
+    kept for the next chunk, so the result doesn't depend on how the input
+    is chunked. It is the same as scipy.signal.spectrogram() with a hann
+    window, constant detrend and density scaling.
+    """
+    def __init__(self, fs, nperseg=None, noverlap=None, window=SPECTROGRAM_WINDOW):
+        self.fs = fs
+        self.nperseg = nperseg or int(SPECTROGRAM_SEGMENT_SEC * fs)
+        self.noverlap = self.nperseg // 2 if noverlap is None else noverlap
+        self.step = self.nperseg - self.noverlap
+        self.window = signal.get_window(window, self.nperseg)
+        self.scale = 1.0 / (fs * np.sum(self.window ** 2))
+        self.freqs = np.fft.rfftfreq(self.nperseg, 1.0 / fs)
+        self.reset()
+
+    def reset(self):
+        self.pending = None
+        # the index of the first pending sample in the whole input
+        self.offset = 0
+
+    def __call__(self, x):
+        return self.process(x)
+
+    def process(self, x):
+        """
+        x:      The next chunk
+        return: (times, Sxx) of the segments completed by this chunk, Sxx
+                is (len(self.freqs), len(times)). The times are the center
+                timestamps of [timestamp, value] rows, or seconds otherwise.
+        """
+        self.pending = concat(self.pending, np.asarray(x))
+        n = 0
+        if self.pending is not None and len(self.pending) >= self.nperseg:
+            n = (len(self.pending) - self.nperseg) // self.step + 1
+        if n == 0:
+            return np.empty((0,)), np.empty((len(self.freqs), 0))
+
+        starts = np.arange(n) * self.step
+        segments = values_of(self.pending)[starts[:,np.newaxis] + np.arange(self.nperseg)]
+        segments = segments - np.mean(segments, axis=1)[:,np.newaxis]
+        sxx = np.abs(np.fft.rfft(segments * self.window, axis=1)) ** 2 * self.scale
+        # one-sided, fold the power of the negative frequencies
+        if self.nperseg % 2:
+            sxx[:,1:] *= 2
+        else:
+            sxx[:,1:-1] *= 2
+
+        if self.pending.ndim == 2:
+            times = self.pending[starts + self.nperseg // 2, 0]
+        else:
+            times = (self.offset + starts + self.nperseg / 2.0) / self.fs
+        consumed = n * self.step
+        self.pending = self.pending[consumed:]
+        self.offset += consumed
+        return times, sxx.T
+
+def spectrogram(chunks, fs, nperseg=None, noverlap=None):
+    """
+    chunks: Chunks of a signal, see Spectrogram, or [data] for a whole array
+    return: (freqs, times, Sxx) like scipy.signal.spectrogram()
+    """
+    s = Spectrogram(fs, nperseg, noverlap)
+    times = []
+    sxx = []
+    for chunk in chunks:
+        t, x = s.process(chunk)
+        times.append(t)
+        sxx.append(x)
+    if not times:
+        return s.freqs, np.empty((0,)), np.empty((len(s.freqs), 0))
+    return s.freqs, np.concatenate(times), np.hstack(sxx)
+
+def spectral_summary(data, fs):
+    """
+    Numbers for a quick quality check of a signal: the frequency of the
+    highest non-DC peak of the welch PSD, the total power, and the share of
+    the power around the power line frequency.
+    """
+    freqs, psd = welch_psd(values_of(np.asarray(data)), fs)
+    if len(psd) < 2:
+        return {}
+    df = freqs[1] - freqs[0]
+    total = float(np.sum(psd) * df)
+    band = np.abs(freqs - POWER_LINE_FREQ) <= POWER_LINE_BAND_HZ
+    return {"peak_hz": float(freqs[1 + np.argmax(psd[1:])]),
+            "total_power": total,
+            "power_line_ratio": float(np.sum(psd[band]) * df / total) if total > 0 else 0.0}
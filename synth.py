@@ -0,0 +1,155 @@
+from __future__ import print_function
+import argparse
+import numpy as np
+
+from parser import TYPE_ACC, TYPE_ECG, TYPE_PPG125, TYPE_PPG512, ALL_TYPES
+from parser import NUM_COLUMNS, TS_COLUMN, ACC_COLUMNS, SIGN_OFFSET
+from filters import ACC_FS, ECG_FS, PPG_FS_125, PPG_FS_512, POWER_LINE_FREQ
+
+START_SECOND = 1519268239
+# the sample rate and the samples per line of every type
+SAMPLE_RATES = {TYPE_ACC: ACC_FS, TYPE_ECG: ECG_FS, TYPE_PPG125: PPG_FS_125, TYPE_PPG512: PPG_FS_512}
+SAMPLES_PER_LINE = {TYPE_ACC: 3, TYPE_ECG: 11, TYPE_PPG125: 11, TYPE_PPG512: 11}
+# the unknown constant column of the sample line
+MARKER_COLUMN = 14
+MARKER = 12345
+# seconds generated and written at a time
+BLOCK_SEC = 600
+
+HEART_RATE_BPM = 70
+HRV_MS = 40
+# (offset from the R peak (s), amplitude (mv), width (s)) of the P, Q, R, S and T waves
+ECG_WAVES = ((-0.2, 0.15, 0.025), (-0.03, -0.1, 0.01), (0.0, 1.2, 0.012),
+             (0.03, -0.25, 0.01), (0.3, 0.35, 0.05))
+# the systolic and dicrotic peaks of a pulse, the pulse arrives after the R peak
+PPG_WAVES = ((0.25, 20.0, 0.08), (0.45, 8.0, 0.1))
+PPG_DC_MV = -380.0
+ACC_GRAVITY = -1000
+
+def parse_duration(s):
+    """ "90", "90s", "10m", "2h" or "1d" to seconds """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+def parse_gap(s):
+    """ "AT:LENGTH", e.g. "10m:30s", to (at second, length in seconds) """
+    at, _, length = s.partition(':')
+    return parse_duration(at), parse_duration(length)
+
+def beat_times(seconds, rng):
+    """ R peak times (s) with a slowly wandering heart rate """
+    n = int(seconds * HEART_RATE_BPM / 60.0 * 1.5) + 2
+    rr = 60.0 / HEART_RATE_BPM + np.cumsum(rng.normal(0, HRV_MS / 1000.0 / 4, n)) * 0.1
+    rr = np.clip(rr + rng.normal(0, HRV_MS / 1000.0, n), 0.4, 1.5)
+    return np.cumsum(rr) - 1.0
+
+def waves(t, beats, shapes):
+    """ Sum gaussian waves around the beats before and after every time """
+    i = np.clip(np.searchsorted(beats, t), 1, len(beats) - 1)
+    v = np.zeros(len(t))
+    for b in (beats[i - 1], beats[i]):
+        for offset, amp, width in shapes:
+            v += amp * np.exp(-0.5 * np.square((t - b - offset) / width))
+    return v
+
+def ecg_mv(t, beats, rng):
+    wander = 0.1 * np.sin(2 * np.pi * 0.3 * t)
+    power_line = 0.05 * np.sin(2 * np.pi * POWER_LINE_FREQ * t)
+    return waves(t, beats, ECG_WAVES) + wander + power_line + rng.normal(0, 0.02, len(t))
+
+def ppg_mv(t, beats, rng):
+    return PPG_DC_MV + waves(t, beats, PPG_WAVES) + rng.normal(0, 0.3, len(t))
+
+def acc_xyz(t, rng):
+    """ Walking for one minute every five minutes, resting otherwise """
+    walking = (t % 300) < 60
+    step = np.sin(2 * np.pi * 2 * t) * np.where(walking, 300, 10)
+    xyz = np.column_stack((step, 0.5 * step, ACC_GRAVITY + step)) + rng.normal(0, 15, (len(t), 3))
+    return np.round(xyz).astype(np.int64)
+
+def to_raw(signal_type, mv):
+    """ Encode mv the way parser.convert_*_array_to_mv() decodes it """
+    if signal_type == TYPE_ECG:
+        v = np.round(mv * 6 * 2097152 / 1000)
+    else:
+        v = np.round(mv * 65536 / (3.2 * 1000))
+    return np.mod(v.astype(np.int64), SIGN_OFFSET)
+
+def type_lines(signal_type, s0, s1, beats, rng):
+    """ Return (sample time of the first sample, raw lines) of the lines starting in [s0, s1) """
+    fs = SAMPLE_RATES[signal_type]
+    per = SAMPLES_PER_LINE[signal_type]
+    first = -(-s0 * fs // per)
+    last = -(-s1 * fs // per)
+    k = np.arange(first, last)
+    t = (k[:,np.newaxis] * per + np.arange(per)) / float(fs)
+
+    rows = np.zeros((len(k), NUM_COLUMNS), dtype=np.int64)
+    rows[:,0] = signal_type
+    rows[:,1] = k % 65536
+    rows[:,MARKER_COLUMN] = MARKER
+    if signal_type == TYPE_ACC:
+        rows[:,ACC_COLUMNS] = acc_xyz(t.ravel(), rng).reshape(len(k), -1)
+    elif signal_type == TYPE_ECG:
+        rows[:,2:2 + per] = to_raw(signal_type, ecg_mv(t.ravel(), beats, rng)).reshape(len(k), -1)
+    else:
+        rows[:,2:2 + per] = to_raw(signal_type, ppg_mv(t.ravel(), beats, rng)).reshape(len(k), -1)
+    return t[:,0], rows
+
+def generate(path, seconds, start=START_SECOND, gaps=(), signal_types=ALL_TYPES, seed=0):
+    """
+    path:         The raw data file to write
+    seconds:      The length of the recording
+    start:        The epoch second of the first line
+    gaps:         (at second, length in seconds) pairs, the clock jumps
+                  ahead by length at that second of the recording
+    signal_types: The types to write
+    seed:         The same seed writes the same file
+
+    The ECG is a train of P-QRS-T waves with some heart rate variability,
+    baseline wander, power line noise and white noise. The PPG follows
+    every beat, and the ACC alternates between walking and resting.
+    """
+    rng = np.random.RandomState(seed)
+    beats = beat_times(seconds, rng)
+    gaps = sorted(gaps)
+    f = open(path, 'w')
+    for s0 in range(0, seconds, BLOCK_SEC):
+        s1 = min(s0 + BLOCK_SEC, seconds)
+        times = []
+        rows = []
+        for t in signal_types:
+            tt, r = type_lines(t, s0, s1, beats, rng)
+            times.append(tt)
+            rows.append(r)
+        times = np.concatenate(times)
+        rows = np.concatenate(rows)
+        # lines of all types interleaved in time order
+        order = np.lexsort((rows[:,0], times))
+        rows = rows[order]
+        second = np.floor(times[order]).astype(np.int64)
+        for at, length in gaps:
+            second[second >= at] += length
+        rows[:,TS_COLUMN] = start + second
+        line_fmt = ','.join(['%d'] * NUM_COLUMNS) + '\n'
+        f.write((line_fmt * len(rows)) % tuple(rows.ravel().tolist()))
+    f.close()
+
+def main():
+    p = argparse.ArgumentParser(description='Write a synthetic raw data file')
+    p.add_argument('path', help='The raw data file to write')
+    p.add_argument('duration', help='e.g. 90s, 10m, 2h or 1d')
+    p.add_argument('--start', type=int, default=START_SECOND, help='The epoch second of the first line')
+    p.add_argument('--gap', action='append', default=[], type=parse_gap,
+                   help='AT:LENGTH, e.g. 10m:30s, the clock jumps ahead by LENGTH at AT, can be repeated')
+    p.add_argument('--types', default=','.join(str(t) for t in ALL_TYPES),
+                   help='Comma separated signal types (default: all)')
+    p.add_argument('--seed', type=int, default=0)
+    args = p.parse_args()
+    types = tuple(int(t) for t in args.types.split(','))
+    generate(args.path, parse_duration(args.duration), args.start, args.gap, types, args.seed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+ChangePipeline and DriveCheckpoint against an in-memory Drive service.
+
+    python -m unittest test_drive_pipeline
+"""
+from __future__ import print_function
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import gd_monitor
+from drive_pipeline import ChangePipeline, Checkpoint
+from gd_monitor import DriveSource, FAILED_POLL_RETRIES, MONITOR_FOLDER_ID, DRIVE_PROCESSED_FILE, \
+    CHANGES_START_TOKEN_FILE, png_name_of
+
+# seconds to wait for the pipeline to finish the submitted changes
+DRAIN_TIMEOUT_SECOND = 30
+
+class Request(object):
+    def __init__(self, fn):
+        self.fn = fn
+
+    def execute(self):
+        return self.fn()
+
+class Batch(object):
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        for request_id, request in self.requests:
+            self.callback(request_id, request.execute(), None)
+
+class FakeDrive(object):
+    """
+    The part of the Drive v3 service that gd_monitor uses, in memory.
+
+    pages:    {page token: changes().list() response}, a token without a
+              page lists no changes
+    contents: {file id: raw data}
+    errors:   {file id: number of downloads that raise before one succeeds}
+    """
+    def __init__(self, pages, contents, errors=None):
+        self.pages = pages
+        self.contents = contents
+        self.errors = dict(errors or {})
+        self.lock = threading.Lock()
+        self.downloads = []
+        self.uploads = []
+
+    def changes(self):
+        return self
+
+    def files(self):
+        return self
+
+    def getStartPageToken(self):
+        return Request(lambda: {'startPageToken': 't0'})
+
+    def list(self, pageToken=None, **kwargs):
+        return Request(lambda: self.pages.get(pageToken, {'newStartPageToken': pageToken, 'changes': []}))
+
+    def get(self, fileId=None, fields=None):
+        return Request(lambda: {'id': fileId, 'trashed': False, 'parents': [MONITOR_FOLDER_ID]})
+
+    def new_batch_http_request(self, callback=None):
+        return Batch(callback)
+
+    def get_media(self, fileId=None):
+        def download():
+            with self.lock:
+                self.downloads.append(fileId)
+                if self.errors.get(fileId):
+                    self.errors[fileId] -= 1
+                    raise IOError("connection reset")
+            return self.contents[fileId]
+        return Request(download)
+
+def download(service, change):
+    return service.get_media(fileId=change.get('file').get('id')).execute()
+
+def render(raw, change):
+    """ Runs in a worker process, so it is a module-level function """
+    if raw == b'bad':
+        raise ValueError("can't parse")
+    return raw.decode('ascii') + '.png', png_name_of(change)
+
+def upload(service, local_png_path, png_name):
+    with service.lock:
+        service.uploads.append((local_png_path, png_name))
+
+def change(file_id, md5):
+    return {'file': {'id': file_id, 'name': file_id + '.txt', 'md5Checksum': md5,
+                     'trashed': False, 'parents': [MONITOR_FOLDER_ID]}}
+
+class CheckpointTest(unittest.TestCase):
+    def test_token_waits_for_the_changes_before_it(self):
+        saved = []
+        checkpoint = Checkpoint(saved.append)
+        first = checkpoint.add()
+        second = checkpoint.add()
+        checkpoint.add_token('t1')
+        checkpoint.done(second)
+        self.assertEqual(saved, [])
+        checkpoint.failed(first)
+        self.assertEqual(saved, ['t1'])
+
+class DrivePipelineTest(unittest.TestCase):
+    def setUp(self):
+        # the token and the processed record are saved in the working directory
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.build_service = gd_monitor.build_service
+        self.pipeline = None
+
+    def tearDown(self):
+        if self.pipeline is not None:
+            self.pipeline.close()
+        gd_monitor.build_service = self.build_service
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def start(self, pages, contents, errors=None):
+        self.service = FakeDrive(pages, contents, errors)
+        gd_monitor.build_service = lambda credentials: self.service
+        self.source = DriveSource(None)
+        self.pipeline = ChangePipeline(self.source.make_service, download, render, upload,
+                                       self.source.checkpoint, net_workers=2, cpu_workers=1,
+                                       retries=2, backoff=0)
+        self.pipeline.start()
+
+    def poll(self):
+        """ Submit the changes of one poll and wait until they are finished """
+        submitted = list(self.source.poll())
+        for c in submitted:
+            self.pipeline.submit(c)
+        deadline = time.time() + DRAIN_TIMEOUT_SECOND
+        while self.source.checkpoint.tokens.in_flight:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+        return [c.get('file').get('id') for c in submitted]
+
+    def saved_token(self):
+        f = open(CHANGES_START_TOKEN_FILE)
+        token = f.read()
+        f.close()
+        return token
+
+    def processed(self):
+        f = open(DRIVE_PROCESSED_FILE)
+        record = json.load(f)
+        f.close()
+        return record
+
+    def test_network_errors_are_retried(self):
+        pages = {'t0': {'newStartPageToken': 't1', 'changes': [change('a', 'A')]}}
+        self.start(pages, {'a': b'a'}, errors={'a': 2})
+        self.assertEqual(self.poll(), ['a'])
+        self.assertEqual(self.service.downloads, ['a'] * 3)
+        self.assertEqual(self.service.uploads, [('a.png', 'a.png')])
+        self.assertEqual(self.pipeline.failed, [])
+        self.assertEqual(self.processed(), {'a': 'A'})
+        self.assertEqual(self.saved_token(), 't1')
+
+    def test_failed_change_is_not_recorded_and_polled_again(self):
+        pages = {'t0': {'newStartPageToken': 't1', 'changes': [change('a', 'A'), change('b', 'B')]}}
+        self.start(pages, {'a': b'a', 'b': b'bad'})
+        self.assertEqual(sorted(self.poll()), ['a', 'b'])
+        # the failed change doesn't hold the token back
+        self.assertEqual(self.saved_token(), 't1')
+        self.assertEqual(self.processed(), {'a': 'A'})
+        for _ in range(FAILED_POLL_RETRIES):
+            self.assertEqual(self.poll(), ['b'])
+        self.assertEqual(self.poll(), [])
+        self.assertEqual(self.pipeline.failed, [(change('b', 'B'), 'render')] * (FAILED_POLL_RETRIES + 1))
+        self.assertEqual(self.processed(), {'a': 'A'})
+        self.assertEqual(self.service.uploads, [('a.png', 'a.png')])
+
+    def test_processed_content_is_skipped(self):
+        pages = {'t0': {'newStartPageToken': 't1', 'changes': [change('a', 'A')]},
+                 't1': {'newStartPageToken': 't2', 'changes': [change('a', 'A')]},
+                 't2': {'newStartPageToken': 't3', 'changes': [change('a', 'A2')]}}
+        self.start(pages, {'a': b'a'})
+        self.assertEqual(self.poll(), ['a'])
+        self.assertEqual(self.poll(), [])
+        self.assertEqual(self.poll(), ['a'])
+        self.assertEqual(self.processed(), {'a': 'A2'})
+        self.assertEqual(self.saved_token(), 't3')
+
+if __name__ == '__main__':
+    unittest.main()